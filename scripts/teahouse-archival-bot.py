@@ -20,6 +20,10 @@ We ignore D301 ("a docstring that contains line continuations should be marked
 raw") in a few places because doing so breaks the line continuation by
 backslash when running the doctest. This is indicated by # noqa: D301 comments.
 
+Doctests that call the live API are kept apart in LIVE_SMOKE_TESTS. Run the
+offline doctests with --selftest, and add the live ones with --live-selftest;
+a plain run goes straight to main().
+
 2.1 - 2018-04-21 (Tigraan): change for PWB compat.
 
 All the various API call stuff must be changed to use OAuth/PWB to log in, so
@@ -41,16 +45,179 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
 MA 02110-1301, USA.
 """
 import collections  # Stackexchange code for list utilities requires this
+import concurrent.futures  # run independent read stages in parallel
+import contextlib  # lock context manager for local data files
+import copy  # hand out copies of cached API results
 import datetime  # get current time, convert time string representations
+import doctest  # offline self-test and live smoke tests
+import fcntl  # locks on local data files shared by several processes
+import html  # section anchors of local dump pages
+import json  # serialization of queued jobs
 import logging  # warning messages etc.
+import os  # atomic replacement of local data files
 import re  # regular expressions, used to match new section edit summaries
+import socket  # default worker name of production runs
+import sqlite3  # work queue shared by several worker processes
+import sys  # exit status of the self-tests
+import tempfile  # unique temporary files for atomic saves
+import threading  # locks for the run-scoped caches
+import time  # lease expiry of queued jobs
+import xml.etree.ElementTree  # revisions read from a local dump
+import xml.parsers.expat  # streaming scan of a local dump
 
 # Pywikibot and associated imports
 import pywikibot
 
 
+# Run-scoped caches
+# A "run" is one pass of the full procedure (cf. main). Within a run, the
+# same API read request should never reach the network twice, and the page
+# history is downloaded once for the widest window needed (cf.
+# revisions_in_window). All of this is dropped by reset_run_cache.
+_run_cache_lock = threading.Lock()
+_run_cache = dict()
+
+
+def reset_run_cache():
+    """Drop all run-scoped cached data and start a new run.
+
+    Also resets the run reference time (cf. run_reference_time).
+    """
+    with _run_cache_lock:
+        _run_cache.clear()
+        _run_cache.update({'now': None,    # reference time for the run
+                           'locks': {},    # one lock per cache key
+                           'api': {},      # manual_API_call results
+                           'history': {},  # page -> widest history fetched
+                           'users': {},    # username -> get_user_info entry
+                           'blocks': {},   # username -> bool (blocked)
+                           'dump': {},     # revid -> sections, cf. use_dump
+                           'config': {},   # revid -> archiver_config
+                           })
+
+
+reset_run_cache()
+
+
+# Run deadline
+# A run can be given a time budget (cf. set_run_deadline). Every API call then
+# gets a timeout that does not exceed the time left, and no new call is made
+# once the budget is exhausted: DeadlineExceeded is raised instead, and what
+# could not be done is deferred to the next run (cf. main).
+PER_CALL_TIMEOUT = 60  # seconds, timeout of a single API call
+_run_deadline = {'at': None}  # time.monotonic() value, or None if no budget
+
+
+class DeadlineExceeded(Exception):
+    """The time budget of the run is exhausted."""
+
+
+def set_run_deadline(budget_seconds):
+    """Set the time budget of the run, in seconds (None for no budget).
+
+    With a budget, PWB is also told to retry failed requests only a couple
+    of times, since its retry waits would otherwise exceed the budget.
+    """
+    if budget_seconds is None:
+        _run_deadline['at'] = None
+        return
+    _run_deadline['at'] = time.monotonic() + budget_seconds
+    pywikibot.config.max_retries = min(pywikibot.config.max_retries, 2)
+
+
+def time_left():
+    """Get the time left before the run deadline, in seconds.
+
+    Output: float (possibly negative), or None if the run has no budget.
+    """
+    if _run_deadline['at'] is None:
+        return None
+    return _run_deadline['at'] - time.monotonic()
+
+
+def check_deadline():
+    """Prepare an API call under the run deadline.
+
+    Raise DeadlineExceeded if the budget is exhausted; otherwise, set the
+    PWB socket timeout to the time left (at most PER_CALL_TIMEOUT).
+
+    Doctests:
+    >>> set_run_deadline(-1)
+    >>> check_deadline()
+    Traceback (most recent call last):
+      (some traceback)
+    DeadlineExceeded: Run deadline reached.
+    >>> set_run_deadline(None)
+    """
+    left = time_left()
+    if left is None:
+        pywikibot.config.socket_timeout = PER_CALL_TIMEOUT
+        return
+    if left <= 0:
+        raise DeadlineExceeded('Run deadline reached.')
+    pywikibot.config.socket_timeout = max(1, min(PER_CALL_TIMEOUT, left))
+
+
+def run_reference_time():
+    """Get the reference (UTC) time of the current run.
+
+    It is set at the first call after reset_run_cache, so that all the
+    "x days ago" timestamps of a run refer to the same instant. With a local
+    dump (cf. use_dump), it is the time of the newest revision of the dump,
+    so that a dump is processed as if the run happened just after it.
+    """
+    with _run_cache_lock:
+        if _run_cache['now'] is None and _dump is not None:
+            latest = dump_query('SELECT MAX(timestamp) FROM revisions')[0][0]
+            if latest is not None:
+                _run_cache['now'] = datetime.datetime.strptime(
+                    mw_timestamp(latest), '%Y%m%d%H%M%S')
+        if _run_cache['now'] is None:
+            # MediaWiki servers use UTC time
+            _run_cache['now'] = datetime.datetime.utcnow()
+        return _run_cache['now']
+
+
+def run_cached(bucket, key, compute):
+    """Get a value from a run-scoped cache, computing it if needed.
+
+    Input:
+    - bucket: (string) name of the cache to use, e.g. 'api'
+    - key: any hashable, the key in that cache
+    - compute: callable without arguments, called on a cache miss
+
+    Concurrent calls with the same key wait for the first one to finish
+    rather than computing the value again.
+
+    Doctests:
+    >>> calls = []
+    >>> run_cached('api', 'doctest-key', lambda: calls.append(1) or 'value')
+    'value'
+    >>> run_cached('api', 'doctest-key', lambda: calls.append(1) or 'value')
+    'value'
+    >>> len(calls)
+    1
+    >>> reset_run_cache()
+    """
+    with _run_cache_lock:
+        cache = _run_cache[bucket]
+        if key in cache:
+            return cache[key]
+        keylock = _run_cache['locks'].setdefault((bucket, key),
+                                                 threading.Lock())
+
+    with keylock:
+        with _run_cache_lock:
+            if key in _run_cache[bucket]:  # computed while we were waiting
+                return _run_cache[bucket][key]
+        value = compute()
+        with _run_cache_lock:
+            _run_cache[bucket][key] = value
+        return value
+
+
 # Commands that directly call the API using PWB
-def manual_API_call(site, **kwargs):  # noqa: D301
+def manual_API_call(site, use_cache=True, **kwargs):
     """Make API request by giving parameters 'by hand'.
 
     Workaround to make direct API calls, because PWB does not (yet?) support
@@ -60,22 +227,23 @@ def manual_API_call(site, **kwargs):  # noqa: D301
     - site is an APISite, e.g. obtained by pywikibot.Site(); PWB should be able
     to read pages there (i.e. be logged with the appropriate permissions if
     needed)
+    - use_cache: (bool) if True, read requests ('parse' and 'query' actions)
+    are memoized for the current run (cf. reset_run_cache)
     - **kwargs: will be passed unmodified to the API for Site
 
-    Doctests:
-    >>> manual_API_call(pywikibot.Site(), action='parse', prop='sections',\
-            format='json', formatversion=2,\
-            oldid=837538913)['parse']['sections'][:2] ==\
-                [{'index': '1', 'anchor': 'Interesting_facts', 'toclevel': 1,\
-                  'line': 'Interesting facts','byteoffset': 3282,'level': '2',\
-                  'number': '1', 'fromtitle': 'Wikipedia:Teahouse'},\
-                 {'index': '2', 'anchor': 'oclc', 'toclevel': 1,\
-                  'line': 'oclc', 'byteoffset': 9831, 'number': '2',\
-                  'fromtitle': 'Wikipedia:Teahouse', 'level': '2'}]
-    True
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
     """
-    request = pywikibot.data.api.Request.create_simple(site, **kwargs)
-    return request.submit()
+    def submit():
+        check_deadline()
+        request = pywikibot.data.api.Request.create_simple(site, **kwargs)
+        return request.submit()
+
+    if not use_cache or kwargs.get('action') not in ('parse', 'query'):
+        return submit()
+
+    key = (str(site),) + tuple(sorted((k, str(v)) for k, v in kwargs.items()))
+    # Callers get their own copy, so they cannot corrupt the cache
+    return copy.deepcopy(run_cached('api', key, submit))
 
 
 def whoami(site=pywikibot.Site()):
@@ -83,7 +251,7 @@ def whoami(site=pywikibot.Site()):
     return site.getuserinfo()['name']
 
 
-def get_user_info(userlist, site=pywikibot.Site()):  # noqa:D301
+def get_user_info(userlist, site=pywikibot.Site()):
     """Query the API for user info.
 
     Input:
@@ -93,23 +261,25 @@ def get_user_info(userlist, site=pywikibot.Site()):  # noqa:D301
     - dict whose keys match the provided userlist; each entry contains user
     information as given by the API
 
-    Doctests:
-    >>> get_user_info(['Jimbo Wales','Sandbox for user warnings']
-    ...              ).keys() == {'Jimbo Wales','Sandbox for user warnings'}
-    True
-    >>> get_user_info(['Jimbo Wales'])['Jimbo Wales']['registration']
-    '2001-03-27T20:47:31Z'
-    >>> get_user_info(['Nonexisting username'])==\
-    {'Nonexisting username': {'missing': '', 'name': 'Nonexisting username'}}
-    True
-    """
-
-    usersgen = site.users(userlist)
+    Results are memoized for the current run (cf. reset_run_cache): only the
+    users not looked up yet are requested from the API.
 
-    # transform into a dictionary whose keys are the usernames
-    resultdict = dict()
-    for entry in usersgen:
-        resultdict[entry['name']] = entry
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
+    """
+    with _run_cache_lock:
+        cache = _run_cache['users']
+        resultdict = {u: cache[u] for u in userlist if u in cache}
+    missing = [u for u in userlist if u not in resultdict]
+
+    if missing:
+        check_deadline()
+        usersgen = site.users(missing)
+
+        # transform into a dictionary whose keys are the usernames
+        for entry in usersgen:
+            resultdict[entry['name']] = entry
+        with _run_cache_lock:
+            _run_cache['users'].update(resultdict)
     return resultdict
 
 
@@ -126,26 +296,31 @@ def get_block_info(userlist, site=pywikibot.Site()):
     - https://www.mediawiki.org/wiki/API:Users
     - https://www.mediawiki.org/w/index.php?title=Topic:Tspl9p7oiyzzm19w
 
-    Doctests:
-    >>> get_block_info(['Tigraan', '85.17.92.13', 'Nonexisting username']
-    ...                ) == {'Tigraan': False,
-    ...                      '85.17.92.13': True,
-    ...                      'Nonexisting username': False}
-    True
-    """
-    blockgen = site.blocks(users=userlist)
+    Results are memoized for the current run (cf. reset_run_cache).
 
-    # transform result into a dict of bool
-    resultdict = dict()
-    for user in userlist:
-        resultdict[user] = False
-    for block in blockgen:
-        resultdict[block['user']] = True
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
+    """
+    with _run_cache_lock:
+        cache = _run_cache['blocks']
+        resultdict = {u: cache[u] for u in userlist if u in cache}
+    missing = [u for u in userlist if u not in resultdict]
+
+    if missing:
+        check_deadline()
+        blockgen = site.blocks(users=missing)
+
+        # transform result into a dict of bool
+        for user in missing:
+            resultdict[user] = False
+        for block in blockgen:
+            resultdict[block['user']] = True
+        with _run_cache_lock:
+            _run_cache['blocks'].update(resultdict)
 
     return resultdict
 
 
-def get_sections_from_revid(pageindicator, site=pywikibot.Site()):  # noqa: D301
+def get_sections_from_revid(pageindicator, site=pywikibot.Site()):
     """Get list of sections from specific page revision.
 
     Input:
@@ -155,27 +330,13 @@ def get_sections_from_revid(pageindicator, site=pywikibot.Site()):  # noqa: D301
         - if an int, treated as a revision number via 'oldid' in
           https://www.mediawiki.org/wiki/API:Parsing_wikitext
 
-    Doctests:
-    >>> get_sections_from_revid(783718598)[:2]==\
-    [{'anchor': 'Request:_World_Cafe',
-    ...  'byteoffset': 3329,
-    ...  'fromtitle': 'Wikipedia:Teahouse',
-    ...  'index': '1',
-    ...  'level': '2',
-    ...  'line': 'Request: World Cafe',
-    ...  'number': '1',
-    ...  'toclevel': 1},
-    ... {'anchor': 'How_to_publish_my_page',
-    ...  'byteoffset': 8292,
-    ...  'fromtitle': 'Wikipedia:Teahouse',
-    ...  'index': '2',
-    ...  'level': '2',
-    ...  'line': 'How to publish my page',
-    ...  'number': '2',
-    ...  'toclevel': 1}
-    ... ]
-    True
+    If a local dump is used (cf. use_dump), the sections are read from it.
+
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
     """
+    if _dump is not None:
+        return dump_sections(pageindicator)
+
     params = {'action': 'parse',
               'prop': 'sections',
               'format': 'json',
@@ -194,7 +355,7 @@ def get_sections_from_revid(pageindicator, site=pywikibot.Site()):  # noqa: D301
 
 def get_revisions_from_api(pagename, oldtimestamp, newtimestamp,
                            maxcontinuenumber=0, continuestring=None,
-                           site=pywikibot.Site()):  # noqa: D301
+                           site=pywikibot.Site()):
     """Get all revisions to specific page since a given timestamp.
 
     Input:
@@ -209,26 +370,13 @@ def get_revisions_from_api(pagename, oldtimestamp, newtimestamp,
     while requesting API resources) and a continuestring, cf. rvcontinue in
     https://www.mediawiki.org/wiki/API:Revisions
 
-    Doctests:
-    >>> get_revisions_from_api('Tiger','2018-03-01T00:00:00Z',
-    ...                        '2018-03-05T00:00:00Z') ==\
-    [{'timestamp': '2018-03-04T15:30:31Z',
-    ...  'parentid': 828307448,
-    ...  'comment': '/* Size */Journal cites: format page range,',
-    ...  'user': 'Rjwilmsi',
-    ...  'revid': 828751877},
-    ... {'timestamp': '2018-03-01T20:11:02Z',
-    ...  'parentid': 828233956,
-    ...  'comment': '/* Reproduction */ hatnote',
-    ...  'user': 'BDD',
-    ...  'revid': 828307448},
-    ... {'timestamp': '2018-03-01T10:08:52Z',
-    ...  'parentid': 828032712,
-    ...  'comment': '/* Taxonomy */ edited ref',
-    ...  'user': 'BhagyaMani',
-    ...  'revid': 828233956}]
-    True
+    If a local dump is used (cf. use_dump), the revisions are read from it.
+
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
     """
+    if _dump is not None:
+        return dump_revisions(pagename, oldtimestamp, newtimestamp)
+
     params = {'action': 'query',
               'prop': 'revisions',
               'titles': pagename,
@@ -269,6 +417,398 @@ def get_revisions_from_api(pagename, oldtimestamp, newtimestamp,
         return revlist
 
 
+# Local dump data source
+# Instead of the live API, the read functions (page history, sections and lead
+# of a revision, list of the archive pages) can use a local MediaWiki XML
+# export or dump of the Teahouse and its archives (cf. use_dump), to reprocess
+# old archival edits offline. The dump is scanned once by a streaming parser
+# to index the byte offset of every revision in an SQLite database saved next
+# to the dump; a revision is then read by seeking to its offset. User and
+# block information are still queried from the API.
+DUMP_INDEX_SUFFIX = '.index.sqlite'
+_dump = None  # {'path': dump file, 'index': its index database}
+
+
+def use_dump(path):
+    """Read page data from the local XML dump at path instead of the API.
+
+    The dump index is built if needed (cf. dump_index_open). If path is None,
+    the API is used again. Either way, a new run starts (cf.
+    reset_run_cache), whose reference time is the end of the dump (cf.
+    run_reference_time).
+
+    Doctests:
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'dump.xml')
+    >>> with open(path, 'w', encoding='utf-8') as f:
+    ...     _ = f.write(
+    ...         '<mediawiki><page><title>Wikipedia:Teahouse</title><ns>4</ns>'
+    ...         '<revision><id>1</id><timestamp>2018-03-01T00:00:00Z'
+    ...         '</timestamp><contributor><username>A</username>'
+    ...         '</contributor><comment>/* Café */ new section</comment>'
+    ...         '<text>== Café ==\\nHé</text></revision>'
+    ...         '<revision><id>2</id><parentid>1</parentid><timestamp>'
+    ...         '2018-03-02T00:00:00Z</timestamp><contributor><ip>1.2.3.4'
+    ...         '</ip></contributor><comment>Archiving</comment>'
+    ...         '<text>Header</text></revision></page>'
+    ...         '<page><title>Wikipedia:Teahouse/Questions/Archive 1</title>'
+    ...         '<ns>4</ns><revision><id>3</id><timestamp>'
+    ...         '2018-03-02T00:00:01Z</timestamp><contributor><username>B'
+    ...         '</username></contributor><text>== Café ==\\nHé</text>'
+    ...         '</revision></page></mediawiki>')
+    >>> use_dump(path)
+    >>> dump_query('SELECT revid, parentid, user, anon FROM revisions '
+    ...            'ORDER BY revid')
+    [(1, 0, 'A', 0), (2, 1, '1.2.3.4', 1), (3, 0, 'B', 0)]
+    >>> list(dump_titles('Teahouse/Questions/Archive', 4))
+    ['Wikipedia:Teahouse/Questions/Archive 1']
+    >>> dump_revision_text(2)  # read at its byte offset, after 'é' bytes
+    'Header'
+    >>> dump_revision_text(3)
+    '== Café ==\\nHé'
+    >>> [rev['revid'] for rev in dump_revisions(
+    ...     'Wikipedia:Teahouse', '20180301000001', '20180303000000')]
+    [2]
+    >>> run_reference_time()
+    datetime.datetime(2018, 3, 2, 0, 0, 1)
+    >>> use_dump(None)
+    >>> for name in os.listdir(directory):
+    ...     os.remove(os.path.join(directory, name))
+    >>> os.rmdir(directory)
+    """
+    global _dump
+    if path is None:
+        _dump = None
+    else:
+        _dump = {'path': path, 'index': dump_index_open(path)}
+    reset_run_cache()
+
+
+def state_path(filename):
+    """Get the path of a local state file (archive index, registry, etc.).
+
+    Runs on a local dump (cf. use_dump) keep their state files in a
+    directory next to the dump (dump path + '.state'), so that they never
+    change the state of the live runs.
+    """
+    if _dump is None:
+        return filename
+    directory = _dump['path'] + '.state'
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def dump_index_build(path, indexpath, chunksize=1 << 20, batchsize=10000):
+    """Scan a MediaWiki XML dump and index its revisions.
+
+    Input: path of an uncompressed XML dump (compressed files cannot be
+    read at an arbitrary offset); indexpath, the SQLite database to fill.
+
+    The database gets the tables
+    - pages: title, ns (namespace number)
+    - revisions: revid, offset (byte offset of its <revision> tag), title,
+      and the fields output by get_revisions_from_api
+
+    The dump is fed to the parser chunk by chunk, the text of the revisions
+    is skipped, and the revisions are written to the database in batches, so
+    memory use does not depend on the size of the dump.
+    """
+    conn = sqlite3.connect(indexpath, isolation_level=None)
+    conn.execute('CREATE TABLE pages ('
+                 'title TEXT PRIMARY KEY, '
+                 'ns INTEGER NOT NULL)')
+    conn.execute('CREATE TABLE revisions ('
+                 'revid INTEGER PRIMARY KEY, '
+                 'offset INTEGER NOT NULL, '
+                 'title TEXT NOT NULL, '
+                 'timestamp TEXT NOT NULL, '
+                 'parentid INTEGER NOT NULL, '
+                 'user TEXT NOT NULL, '
+                 'anon INTEGER NOT NULL, '
+                 'comment TEXT NOT NULL)')
+    conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value)')
+
+    parser = xml.parsers.expat.ParserCreate()
+    stack = []   # names of the open elements
+    buf = []     # text of the current element, if it is a field we keep
+    page = {}    # fields of the current <page>
+    rev = {}     # fields of the current <revision>
+    batch = []   # revisions not written yet
+    keep = ('title', 'ns', 'id', 'parentid', 'timestamp', 'username', 'ip',
+            'comment')
+
+    def flush():
+        conn.executemany('INSERT OR REPLACE INTO revisions VALUES '
+                         '(?, ?, ?, ?, ?, ?, ?, ?)', batch)
+        del batch[:]
+
+    def start(name, attrs):
+        stack.append(name)
+        del buf[:]
+        if name == 'page':
+            page.clear()
+        elif name == 'revision':
+            rev.clear()
+            rev['offset'] = parser.CurrentByteIndex
+
+    def chars(data):
+        if stack[-1] in keep:  # never buffer the (large) <text>
+            buf.append(data)
+
+    def end(name):
+        stack.pop()
+        value = ''.join(buf)
+        del buf[:]
+        parent = stack[-1] if stack else None
+        if parent == 'page' and name in ('title', 'ns'):
+            page[name] = value
+        elif parent == 'revision' and name in keep:
+            rev[name] = value
+        elif parent == 'contributor' and name in ('username', 'ip'):
+            rev[name] = value
+        elif name == 'revision':
+            batch.append((int(rev['id']), rev['offset'], page['title'],
+                          rev['timestamp'], int(rev.get('parentid', 0)),
+                          rev.get('username', rev.get('ip', '')),
+                          int('ip' in rev), rev.get('comment', '')))
+            if len(batch) >= batchsize:
+                flush()
+        elif name == 'page':
+            conn.execute('INSERT OR REPLACE INTO pages VALUES (?, ?)',
+                         (page['title'], int(page.get('ns', 0))))
+
+    parser.StartElementHandler = start
+    parser.CharacterDataHandler = chars
+    parser.EndElementHandler = end
+
+    conn.execute('BEGIN')
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            parser.Parse(chunk, False)
+    parser.Parse(b'', True)
+    flush()
+    conn.execute('CREATE INDEX revisions_by_title '
+                 'ON revisions (title, timestamp)')
+    conn.execute('COMMIT')
+    conn.close()
+
+
+def dump_index_open(path):
+    """Get the index database of a dump, building it if needed.
+
+    The index (cf. dump_index_build) is saved next to the dump (path +
+    DUMP_INDEX_SUFFIX), and rebuilt when the dump file changes.
+    Output: path of the index database.
+    """
+    stat = os.stat(path)
+    indexpath = path + DUMP_INDEX_SUFFIX
+    if os.path.exists(indexpath):
+        conn = sqlite3.connect(indexpath)
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+        except sqlite3.DatabaseError:
+            meta = {}
+        finally:
+            conn.close()
+        if meta.get('size') == stat.st_size \
+                and meta.get('mtime') == stat.st_mtime:
+            return indexpath
+
+    logging.info('Indexing dump ' + path)
+    # Built aside, so that an interrupted build is never used
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(indexpath) or '.',
+                                   prefix=os.path.basename(indexpath) + '.',
+                                   suffix='.tmp')
+    os.close(fd)  # an empty file is an empty SQLite database
+    try:
+        dump_index_build(path, tmppath)
+        conn = sqlite3.connect(tmppath)
+        with conn:
+            conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                             [('size', stat.st_size),
+                              ('mtime', stat.st_mtime)])
+        conn.close()
+        os.replace(tmppath, indexpath)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+    return indexpath
+
+
+def dump_query(sql, params=()):
+    """Run a read query on the dump index (cf. use_dump).
+
+    Output: list of the result rows.
+    """
+    conn = sqlite3.connect(_dump['index'])
+    try:
+        return conn.execute(sql, params).fetchall()
+    finally:
+        conn.close()
+
+
+def dump_revision_text(revid, chunksize=1 << 16):
+    """Get the wikitext of a revision from the dump (cf. use_dump)."""
+    rows = dump_query('SELECT offset FROM revisions WHERE revid = ?',
+                      (revid,))
+    if not rows:
+        raise KeyError('Revision not found in the dump', revid)
+
+    end_tag = b'</revision>'
+    data = b''
+    with open(_dump['path'], 'rb') as f:
+        f.seek(rows[0][0])
+        end = -1
+        while end < 0:
+            chunk = f.read(chunksize)
+            if not chunk:
+                raise ValueError('Truncated revision in the dump', revid)
+            # only search where the end tag could be
+            start = max(0, len(data) - len(end_tag))
+            data += chunk
+            end = data.find(end_tag, start)
+
+    fragment = data[:end + len(end_tag)]
+    element = xml.etree.ElementTree.fromstring(fragment)
+    return element.findtext('text', default='')
+
+
+def dump_latest_revid(title):
+    """Get the revid of the latest revision of a page in the dump."""
+    rows = dump_query('SELECT revid FROM revisions WHERE title = ? '
+                      'ORDER BY timestamp DESC, revid DESC LIMIT 1',
+                      (title.replace('_', ' '),))
+    if not rows:
+        raise KeyError('Page not found in the dump', title)
+    return rows[0][0]
+
+
+def iso_timestamp(timestamp):
+    """Convert a timestamp string to the ISO 8601 format of the API.
+
+    Doctests:
+    >>> iso_timestamp('20180304153031')
+    '2018-03-04T15:30:31Z'
+    """
+    ts = mw_timestamp(timestamp)
+    return '{}-{}-{}T{}:{}:{}Z'.format(ts[0:4], ts[4:6], ts[6:8], ts[8:10],
+                                       ts[10:12], ts[12:14])
+
+
+def dump_revisions(pagename, oldtimestamp, newtimestamp):
+    """Get the revisions of a page in the dump between two timestamps.
+
+    Input and output: cf. get_revisions_from_api (all the revisions of the
+    window are returned at once, newest first).
+    """
+    rows = dump_query('SELECT revid, parentid, timestamp, user, anon, '
+                      'comment FROM revisions WHERE title = ? '
+                      'AND timestamp BETWEEN ? AND ? '
+                      'ORDER BY timestamp DESC, revid DESC',
+                      (pagename.replace('_', ' '), iso_timestamp(oldtimestamp),
+                       iso_timestamp(newtimestamp)))
+    revisions = []
+    for revid, parentid, timestamp, user, anon, comment in rows:
+        rev = {'revid': revid, 'parentid': parentid, 'timestamp': timestamp,
+               'user': user, 'comment': comment}
+        if anon:
+            rev['anon'] = ''  # as in the API output
+        revisions.append(rev)
+    return revisions
+
+
+def dump_titles(prefix, namespace):
+    """Get the titles of the pages of the dump starting with prefix.
+
+    Input: cf. archive_index_rebuild (prefix does not include the namespace).
+    """
+    for title, in dump_query('SELECT title FROM pages WHERE ns = ? '
+                             'ORDER BY title', (namespace,)):
+        name = title.split(':', 1)[-1] if namespace != 0 else title
+        if name.startswith(prefix):
+            yield title
+
+
+def dump_sections(pageindicator):
+    """Get list of sections of a page revision from the dump.
+
+    Input and output: cf. get_sections_from_revid; if pageindicator is a
+    str, the latest revision of that page in the dump is used.
+    """
+    if isinstance(pageindicator, int):
+        revid = pageindicator
+    else:
+        revid = dump_latest_revid(pageindicator)
+    sections = run_cached('dump', revid,
+                          lambda: wikitext_sections(dump_revision_text(revid)))
+    return copy.deepcopy(sections)
+
+
+SECTION_HEADING = re.compile(r'^(={1,6})(.+?)\1[ \t]*$', re.MULTILINE)
+
+
+def blank_comments(wikitext):
+    """Replace HTML comments by spaces, keeping line breaks and offsets."""
+    return re.sub(r'<!--.*?(-->|$)',
+                  lambda m: re.sub(r'[^\n]', ' ', m.group()),
+                  wikitext, flags=re.DOTALL)
+
+
+def wikitext_sections(wikitext):
+    """Get the list of sections of a page from its wikitext.
+
+    Output: list of dict with the keys 'level', 'line', 'anchor' and 'index'
+    of the sections given by the parse API (cf. get_sections_from_revid).
+
+    This approximates the parser: wikilinks and bold/italic are rendered as
+    in the API 'line', but templates in headings are not expanded.
+
+    Doctests:
+    >>> text = ("Intro\\n== Help with [[WP:AFC|AfC]] ==\\n<!-- == No == -->\\n"
+    ...         "=== ''Why'' ===\\nText\\n== Hi ==\\n==Hi==\\n")
+    >>> for s in wikitext_sections(text):
+    ...     print(s['index'], s['level'], s['line'], s['anchor'])
+    1 2 Help with AfC Help_with_AfC
+    2 3 <i>Why</i> Why
+    3 2 Hi Hi
+    4 2 Hi Hi_2
+    """
+    sections = []
+    anchors = collections.Counter()
+    for i, m in enumerate(SECTION_HEADING.finditer(blank_comments(wikitext))):
+        line = m.group(2).strip()
+        line = re.sub(r'\[\[(?:[^|\]]*\|)?([^\]]*)\]\]', r'\1', line)
+        line = re.sub(r'\[https?://\S+ ([^\]]*)\]', r'\1', line)
+        line = re.sub(r"'''(.+?)'''", r'<b>\1</b>', line)
+        line = re.sub(r"''(.+?)''", r'<i>\1</i>', line)
+
+        anchor = html.unescape(re.sub(r'<[^>]*>', '', line)).replace(' ', '_')
+        anchors[anchor] += 1
+        if anchors[anchor] > 1:  # duplicate headings get numbered anchors
+            anchor += '_' + str(anchors[anchor])
+
+        sections.append({'level': str(len(m.group(1))),
+                         'line': line,
+                         'anchor': anchor,
+                         'index': str(i + 1),
+                         })
+    return sections
+
+
+def wikitext_section0(wikitext):
+    """Get the lead section (before the first heading) of a wikitext.
+
+    Doctests:
+    >>> wikitext_section0('{{Archiver}}\\n== First ==\\nText')
+    '{{Archiver}}\\n'
+    """
+    m = SECTION_HEADING.search(blank_comments(wikitext))
+    return wikitext[:m.start()] if m else wikitext
+
+
 # Other commands
 def isnotifiable(users):
     """Check if specified users can be notified.
@@ -284,12 +824,23 @@ def isnotifiable(users):
     Current policy is to notify anyone regardless of 'age' (edit count) or
     groups (autoconfirmed etc.) but to not notify blocked users.
 
-    Doctests:
+    Doctests (offline: the run-scoped caches are filled with fixtures):
+    >>> reset_run_cache()
+    >>> _run_cache['users'].update(
+    ...     {'Tigraan': {'name': 'Tigraan', 'editcount': 2000},
+    ...      '85.17.92.13': {'name': '85.17.92.13', 'invalid': ''},
+    ...      'Nonexisting username': {'name': 'Nonexisting username',
+    ...                               'missing': ''}})
+    >>> _run_cache['blocks'].update({'Tigraan': False, '85.17.92.13': True,
+    ...                              'Nonexisting username': False})
     >>> isnotifiable(['Tigraan', '85.17.92.13', 'Nonexisting username']
     ...              ) == {'Tigraan': True,
     ...                    '85.17.92.13': False,
     ...                    'Nonexisting username': False}
     True
+    >>> reset_run_cache()
+
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
     """
     # Block information
     isblocked = get_block_info(users)
@@ -341,10 +892,11 @@ def UTC_timestamp_x_days_ago(days_offset=0):
     """Timestamp x days ago in Mediawiki format.
 
     Input is the number of days that will be substracted from the
-    current timestamp.
+    current timestamp, i.e. the reference time of the run (cf.
+    run_reference_time).
     Format: cf. https://www.mediawiki.org/wiki/Manual:Timestamp
     """
-    current_time = datetime.datetime.utcnow()  # MediaWiki servers use UTC time
+    current_time = run_reference_time()
     offset = datetime.timedelta(days=-days_offset)
     UTC_time_then = current_time + offset
 
@@ -352,6 +904,21 @@ def UTC_timestamp_x_days_ago(days_offset=0):
     return timestamp
 
 
+def mw_timestamp(timestamp):
+    """Convert a timestamp string to the 14-digit Mediawiki format.
+
+    The API returns ISO 8601 timestamps but accepts both formats as input;
+    converting to the 14-digit format allows direct string comparison.
+
+    Doctests:
+    >>> mw_timestamp('2018-03-04T15:30:31Z')
+    '20180304153031'
+    >>> mw_timestamp('20180304153031')
+    '20180304153031'
+    """
+    return re.sub(r'\D', '', timestamp)
+
+
 def safe_list_diff(listbefore, listafter):
     """Find elements that were removed from one list to another.
 
@@ -412,7 +979,108 @@ def safe_list_diff(listbefore, listafter):
     return final_list
 
 
-def list_matching(ta, threadscreated):
+def normalize_title(title):
+    """Normalize a thread title for fuzzy comparison.
+
+    Wikilinks are replaced by their displayed text, HTML tags are dropped,
+    underscores (as in anchors) count as spaces, and punctuation and case
+    are ignored.
+
+    Doctests:
+    >>> normalize_title(' How to cite [[WP:RS|reliable sources]]?? ')
+    'how to cite reliable sources'
+    >>> normalize_title('How_to_cite_<i>reliable</i>_sources')
+    'how to cite reliable sources'
+    """
+    title = re.sub(r'\[\[(?:[^\]|]*\|)?([^\]]*)\]\]', r'\1', title)
+    title = re.sub(r'<[^>]*>', '', title)
+    title = re.sub(r'[\W_]+', ' ', title.lower())
+    return ' '.join(title.split())
+
+
+def ngrams(string, n=3):
+    """Get the set of character n-grams of a string.
+
+    The string is padded with one space on each side, so that short words
+    still produce n-grams.
+
+    Doctests:
+    >>> sorted(ngrams('abc'))
+    [' ab', 'abc', 'bc ']
+    """
+    padded = ' ' + string + ' '
+    if len(padded) < n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def ngram_index(names, n=3):
+    """Build an n-gram index over a list of titles, for fuzzy_lookup.
+
+    Input: names is a list of strings (thread titles); n is the n-gram size.
+    Output: dict with the keys 'n', 'grams' (list of n-gram sets, in the
+    order of names) and 'postings' (dict n-gram -> set of indices in names).
+
+    Titles are normalized first (cf. normalize_title).
+    """
+    grams = [ngrams(normalize_title(name), n) for name in names]
+    postings = collections.defaultdict(set)
+    for i, namegrams in enumerate(grams):
+        for gram in namegrams:
+            postings[gram].add(i)
+    return {'n': n, 'grams': grams, 'postings': dict(postings)}
+
+
+def fuzzy_lookup(index, query, threshold, maxpostings=None):
+    """Find titles similar to a query in an n-gram index.
+
+    Input: index comes from ngram_index; query is a string (thread title);
+    threshold is a float between 0 and 1.
+
+    Output: sorted list of indices (in the names given to ngram_index) of
+    all titles whose similarity to query is at least threshold. Similarity
+    is the Dice coefficient of the n-gram sets of the normalized titles.
+
+    Only the titles sharing at least one n-gram with the query are scored,
+    so that a lookup does not scan the whole index. N-grams found in many
+    titles (more than maxpostings, by default a tenth of the index but at
+    least 20) are not used to find candidates, except the rarest n-gram of
+    the query if all its n-grams are that frequent; titles that only share
+    frequent n-grams with the query are therefore not found.
+
+    Doctests:
+    >>> idx = ngram_index(['How to publish my page', 'Picture problem',
+    ...                    'How to publish my draft'])
+    >>> fuzzy_lookup(idx, 'How to publish my page?', 0.8)
+    [0]
+    >>> fuzzy_lookup(idx, 'How to publish my', 0.8)
+    [0, 2]
+    >>> fuzzy_lookup(idx, 'Something else entirely', 0.8)
+    []
+    """
+    querygrams = ngrams(normalize_title(query), index['n'])
+    postings = index['postings']
+    if maxpostings is None:
+        maxpostings = max(20, len(index['grams']) // 10)
+
+    probed = [gram for gram in querygrams
+              if len(postings.get(gram, ())) <= maxpostings]
+    if not probed:
+        probed = [min(querygrams, key=lambda g: len(postings.get(g, ())))]
+    candidates = set()
+    for gram in probed:
+        candidates.update(postings.get(gram, ()))
+
+    matches = []
+    for i in candidates:
+        count = len(querygrams & index['grams'][i])
+        score = 2 * count / (len(querygrams) + len(index['grams'][i]))
+        if score >= threshold:
+            matches.append(i)
+    return sorted(matches)
+
+
+def list_matching(ta, threadscreated, fuzzy_threshold=None):
     """Match string elements from two lists.
 
     We have on the one hand a list of threads that underwent the last
@@ -430,6 +1098,16 @@ def list_matching(ta, threadscreated):
     Leading and trailing white spaces are discarded during the comparison
     because of some obscure false positive cases identified at test run.
 
+    If fuzzy_threshold (float between 0 and 1) is given, threads with no
+    exact match are compared to the creations by similarity of their titles
+    (cf. fuzzy_lookup), e.g. to recover a heading where punctuation or a link
+    was added after creation. The same rule applies both ways: a thread is
+    only matched if exactly one creation is above the threshold, and that
+    creation is not a candidate of another thread, so that the result does
+    not depend on the order of ta. Creations that already match a thread
+    exactly are not candidates. A thread matched by similarity is output
+    under its archived heading ('name'), the one to look for in the archives.
+
     Inputs: list of strings and list of dict
     Output: list of dict
 
@@ -444,13 +1122,66 @@ def list_matching(ta, threadscreated):
     ...               ) == [{'revid': 1, 'name': 'Thread#1','user': 'User#1'},
     ...                     {'revid': 3, 'name': 'Thread#3','user': 'User#3'}]
     True
+    >>> list_matching(['How to cite [[WP:RS|reliable sources]]?'],
+    ...               [{'revid': 1, 'name': 'How to cite reliable sources',
+    ...                 'user': 'User#1'}],
+    ...               fuzzy_threshold=0.8)
+    [{'revid': 1, 'name': 'How to cite [[WP:RS|reliable sources]]?', \
+'user': 'User#1'}]
+    >>> list_matching(['How to publish my page', 'How to publish my page?'],
+    ...               [{'revid': 1, 'name': 'How to publish my page',
+    ...                 'user': 'User#1'}],
+    ...               fuzzy_threshold=0.8)
+    [{'revid': 1, 'name': 'How to publish my page', 'user': 'User#1'}]
+    >>> list_matching(['How to publish my page?', 'How to publish my page!'],
+    ...               [{'revid': 1, 'name': 'How to publish my page',
+    ...                 'user': 'User#1'}],
+    ...               fuzzy_threshold=0.8)
+    []
     """
     output = []
 
+    # Exact lookup table, to avoid comparing every pair of threads
+    indices_by_name = collections.defaultdict(list)
+    for j, k in enumerate(threadscreated):
+        indices_by_name[k['name'].strip()].append(j)
+
+    # Fuzzy candidates of the threads without exact match, among the
+    # creations not matched exactly; all are collected before matching
+    candidates = dict()
+    unmatched = [i for i in range(len(ta))
+                 if not indices_by_name.get(ta[i].strip())]
+    if fuzzy_threshold is not None and unmatched:
+        claimed = set()
+        for name in ta:
+            claimed.update(indices_by_name.get(name.strip(), []))
+        index = ngram_index([k['name'] for k in threadscreated])
+        for i in unmatched:
+            candidates[i] = [j for j in fuzzy_lookup(index, ta[i].strip(),
+                                                     fuzzy_threshold)
+                             if j not in claimed]
+    # Number of threads having each creation as candidate
+    claims = collections.Counter(j for js in candidates.values() for j in js)
+
     for i in range(len(ta)):
         cur_str = ta[i].strip()
-        matching_indices = [j for j, k in enumerate(threadscreated)
-                            if k['name'].strip() == cur_str]
+        matching_indices = indices_by_name.get(cur_str, [])
+
+        if i in candidates:
+            matching_indices = candidates[i]
+            if len(matching_indices) == 1 and claims[matching_indices[0]] == 1:
+                cn = threadscreated[matching_indices[0]]['name']
+                logging.info('Fuzzy match for thread '
+                             + '"{tn}": "{cn}"'.format(tn=cur_str, cn=cn))
+                output.append(dict(threadscreated[matching_indices[0]],
+                                   name=cur_str))
+                continue
+            if len(matching_indices) == 1:
+                logging.warning('Fuzzy match shared with another thread (all '
+                                + 'will be ignored) for the creation of the '
+                                + 'following thread: "{tn}"'.format(
+                                    tn=cur_str))
+                continue
 
         if len(matching_indices) == 1:  # normal case, one single match
             output.append(threadscreated[matching_indices[0]])
@@ -482,7 +1213,8 @@ def traverse_list_of_sections(inputlistofdict):
     return output_list
 
 
-def find_section_anchor(inputlistofdict, sectionname):
+def find_section_anchor(inputlistofdict, sectionname, fuzzy_threshold=None,
+                        index=None):
     """Match a section name to the output of get_sections_from_revid.
 
     Input: inputlistofdict comes from get_sections_from_revid (list of dict),
@@ -495,6 +1227,11 @@ def find_section_anchor(inputlistofdict, sectionname):
 
     Leading and trailing spaces are removed for the comparison.
 
+    If fuzzy_threshold is given and no section has exactly that name, the
+    sections whose name is similar enough are returned instead (cf.
+    fuzzy_lookup). index is the ngram_index of the section names, which
+    callers can build once to search the same page repeatedly.
+
     Doctests:
     >>> find_section_anchor([{'anchor': 'Request:_World_Cafe',
     ...                       'byteoffset': 3329,
@@ -522,10 +1259,186 @@ def find_section_anchor(inputlistofdict, sectionname):
         if sectionname.strip() == item['line'].strip():
             outlist.append(item['anchor'])
 
+    if not outlist and fuzzy_threshold is not None:
+        if index is None:
+            index = ngram_index([item['line'] for item in inputlistofdict])
+        for i in fuzzy_lookup(index, sectionname, fuzzy_threshold):
+            outlist.append(inputlistofdict[i]['anchor'])
+
     return outlist
 
 
-def search_archives_for_section(links_to_search, sectionnames):
+# Archive index
+# Persistent local index of the sections of all Teahouse archive pages, used
+# to find archived threads when the archive link of the archival edit summary
+# is missing or wrong. It is built once (cf. archive_index_rebuild) and then
+# kept up to date from the archive pages read at each run.
+ARCHIVE_INDEX_FILE = 'teahouse-archive-index.json'
+
+
+def archive_index_load(path=ARCHIVE_INDEX_FILE):
+    """Load the archive index from disk.
+
+    Output: dict with the keys 'pages' (page title -> list of [line, anchor]
+    of its sections) and 'titles' (normalized section title, cf.
+    normalize_title -> list of [page title, anchor]). An empty index is
+    returned if the file does not exist.
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'pages': {}, 'titles': {}}
+
+
+# Read once, since os.umask can only be read by setting it
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def save_json_atomically(data, path, private=False):
+    """Write data as JSON, replacing the file only once fully written.
+
+    That way, a crash while saving never leaves a truncated file behind, and
+    concurrent saves (e.g. by several workers) each write their own
+    temporary file. If private is True, the file is only readable by its
+    owner.
+
+    Processes that load, modify and save the same file must hold its lock
+    (cf. file_lock), otherwise one of the modifications is lost.
+    """
+    fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path) or '.',
+                                   prefix=os.path.basename(path) + '.',
+                                   suffix='.tmp')
+    try:
+        os.chmod(tmppath, 0o600 if private else 0o666 & ~_UMASK)
+        with open(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmppath, path)
+    except BaseException:
+        os.unlink(tmppath)
+        raise
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Hold an exclusive lock on a local data file.
+
+    The lock is taken on path + '.lock', and is exclusive across processes
+    and threads, so that the load-modify-save cycles of a file shared by
+    several workers do not overlap.
+    """
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def archive_index_update(index, page, sections):
+    """Replace the indexed sections of an archive page.
+
+    Input: index comes from archive_index_load; page is the title of the
+    archive page; sections is the list of its sections, as output by
+    get_sections_from_revid.
+
+    Doctests:
+    >>> index = {'pages': {}, 'titles': {}}
+    >>> archive_index_update(index, 'Archive_1', [{'line': 'Help!',
+    ...                                           'anchor': 'Help!'}])
+    >>> index['titles']
+    {'help': [['Archive 1', 'Help!']]}
+    >>> archive_index_update(index, 'Archive 1', [{'line': 'Hi',
+    ...                                           'anchor': 'Hi'}])
+    >>> index['titles']
+    {'hi': [['Archive 1', 'Hi']]}
+    """
+    page = page.replace('_', ' ')
+    titles = index['titles']
+
+    # Remove the previous entries of the page
+    for line, anchor in index['pages'].get(page, []):
+        key = normalize_title(line)
+        entries = [e for e in titles.get(key, []) if e[0] != page]
+        if entries:
+            titles[key] = entries
+        else:
+            titles.pop(key, None)
+
+    index['pages'][page] = [[item['line'], item['anchor']]
+                            for item in sections]
+    for item in sections:
+        titles.setdefault(normalize_title(item['line']), []).append(
+            [page, item['anchor']])
+
+
+def archive_number(page):
+    """Get the number of an archive page, or None if it has none.
+
+    Doctests:
+    >>> archive_number('Wikipedia:Teahouse/Questions/Archive 812')
+    812
+    >>> archive_number('Wikipedia:Teahouse') is None
+    True
+    """
+    m = re.search(r'Archive[ _](\d+)$', page)
+    return int(m.group(1)) if m else None
+
+
+def archive_index_resolve(index, sectionname, min_archive=None):
+    """Find the archive links of a section name in the archive index.
+
+    Output: list of links (page title + '#' + anchor) of all the indexed
+    sections whose normalized title (cf. normalize_title) is that of
+    sectionname. If min_archive is given, only the archive pages with at
+    least that number (cf. archive_number) are considered.
+
+    Doctests:
+    >>> index = {'pages': {}, 'titles': {}}
+    >>> archive_index_update(index, 'Archive 1', [{'line': 'Help!',
+    ...                                           'anchor': 'Help!'}])
+    >>> archive_index_resolve(index, 'help')
+    ['Archive 1#Help!']
+    >>> archive_index_resolve(index, 'help', min_archive=2)
+    []
+    """
+    return [page + '#' + anchor for page, anchor
+            in index['titles'].get(normalize_title(sectionname), [])
+            if min_archive is None
+            or (archive_number(page) or 0) >= min_archive]
+
+
+def archive_index_rebuild(index, prefix='Teahouse/Questions/Archive',
+                          namespace=4, site=pywikibot.Site(), force=False):
+    """Index all the archive pages.
+
+    Input:
+    - index: comes from archive_index_load; updated in place
+    - prefix, namespace: the archive pages are all the pages of namespace
+      whose title starts with prefix (default: Wikipedia:Teahouse/Questions/
+      Archive...)
+    - force: (bool) if False, pages already indexed are skipped
+
+    This makes one API call per archive page, so it is meant to be run once
+    (or to fill gaps); the index is then kept up to date incrementally by
+    search_archives_for_section. If a local dump is used (cf. use_dump), the
+    archive pages are those of the dump.
+    """
+    if _dump is not None:
+        titles = dump_titles(prefix, namespace)
+    else:
+        titles = (page.title() for page
+                  in site.allpages(prefix=prefix, namespace=namespace))
+    for title in titles:
+        if not force and title in index['pages']:
+            continue
+        archive_index_update(index, title, get_sections_from_revid(title))
+
+
+def search_archives_for_section(links_to_search, sectionnames,
+                                fuzzy_threshold=None, archive_index=None,
+                                min_archive=None):
     """Find links to archived threads.
 
     This checks the current content of multiple archive links for the
@@ -534,21 +1447,44 @@ def search_archives_for_section(links_to_search, sectionnames):
 
     Input: links_to_search is a list of strings, the names (shortened URL) of
     archive pages to search; sectionnames is a list of strings, the 'anchor's
-    to match.
-
-    Doctests:
-    >>> search_archives_for_section(['Wikipedia:Teahouse/Questions/Archive_98',
-    ...                              'Wikipedia:Teahouse/Questions/Archive_99'
-    ...                              ],['Picture problem', 'Blog as reference?'])  # noqa: E501
-    ['Wikipedia:Teahouse/Questions/Archive_98#Picture_problem', 'Wikipedia:Teahouse/Questions/Archive_99#Blog_as_reference?']
+    to match; fuzzy_threshold, if given, enables similarity matching for
+    the sections that have no exact match in any of the pages (cf.
+    find_section_anchor).
+
+    If archive_index is given (cf. archive_index_load), it is updated with
+    the current content of the archive links. If min_archive is also given,
+    the index is used as a fallback to resolve the sections that are not
+    found in the archive links: a unique match in the archive pages numbered
+    min_archive or more is accepted. Older archives cannot hold a thread of
+    this archival edit, and are not checked again at each run. An archive
+    link that cannot be read (e.g. a missing page) is logged and searched as
+    an empty page, so that the index can still resolve its threads.
+
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
     """
     # First, query the API for the content of the archive links
     archive_contents = dict()
     for archivelink in links_to_search:
-        linkcontent = get_sections_from_revid(archivelink)
+        try:
+            linkcontent = get_sections_from_revid(archivelink)
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            # Wrong link (e.g. missing page): its threads are searched
+            # elsewhere, i.e. in the other links or the archive index
+            logging.warning('Archive link "{l}" could '.format(l=archivelink)
+                            + 'not be read; no thread will be found there.',
+                            exc_info=True)
+            archive_contents[archivelink] = []
+            continue
         archive_contents[archivelink] = linkcontent  # links as keys, why not
+        if archive_index is not None:
+            archive_index_update(archive_index, archivelink, linkcontent)
 
         # print(linkcontent)
+    # n-gram indexes of the archive pages, only built if needed
+    archive_indexes = dict()
+
     # Loop over the queried section names
     out_links = []
 
@@ -562,11 +1498,38 @@ def search_archives_for_section(links_to_search, sectionnames):
 
             matches += linkmatches  # append current matches to old ones
 
+        # Fuzzy matching only if no page has an exact match, so that an
+        # exact match is never made ambiguous by a similar title elsewhere
+        if not matches and fuzzy_threshold is not None:
+            for arlink in links_to_search:
+                if arlink not in archive_indexes:
+                    archive_indexes[arlink] = ngram_index(
+                        [item['line'] for item in archive_contents[arlink]])
+                linkmatches = find_section_anchor(
+                    archive_contents[arlink], sn,
+                    fuzzy_threshold=fuzzy_threshold,
+                    index=archive_indexes[arlink])
+                if linkmatches:
+                    candidatelink = arlink
+
+                matches += linkmatches
+
         if len(matches) == 1:  # the good case: we found exactly one match
             fullarchivelink = candidatelink + "#" + matches[0]
             out_links.append(fullarchivelink)
             continue
 
+        # Archive link missing or wrong: fall back to the archive index
+        if not matches and archive_index is not None \
+                and min_archive is not None:
+            indexmatches = archive_index_resolve(archive_index, sn,
+                                                 min_archive=min_archive)
+            if len(indexmatches) == 1:
+                logging.info('Thread "{tn}" found '.format(tn=sn)
+                             + 'in the archive index.')
+                out_links.append(indexmatches[0])
+                continue
+
         # If we did not continue, we are in the bad case, so we default
         # the link to an empty string
         out_links.append('')
@@ -593,10 +1556,7 @@ def sections_removed_by_diff(revid1, revid2):
 
     Output: a list of strings, the names of removed threads.
 
-    Doctests:
-    (Cf. https://en.wikipedia.org/w/index.php?oldid=783715718&diff=783718598)
-    >>> sections_removed_by_diff(783715718,783718598)[:2]
-    ['Red links', 'how to undo a merge made 6 yrs ago']
+    Live smoke test: cf. LIVE_SMOKE_TESTS.
     """
     json1 = get_sections_from_revid(revid1)
     sec_list_1 = traverse_list_of_sections(json1)
@@ -608,24 +1568,68 @@ def sections_removed_by_diff(revid1, revid2):
     return set_of_sections_removed
 
 
-def revisions_since_x_days(pagename, ndays, maxcontinuenumber=0):
-    """Get revision data for a given page for the last n days.
+def revisions_in_window(pagename, oldtimestamp, newtimestamp,
+                        maxcontinuenumber=0):
+    """Get revision data for a given page between two timestamps.
 
     Input:
     - pagename (string), the name of the page
-    - ndays (int or float): lookup revisions of the last ndays days
+    - oldtimestamp, newtimestamp (strings): timestamps in Mediawiki format
     - maxcontinuenumber (int): recursion limit for API calls
     Output: a list of dict (cf. get_revisions_from_api).
+
+    This is a run-scoped view of the page history: the widest window pulled
+    so far in the run is kept in memory, and windows that it contains (with
+    no more API continues) are served from it without any API call. To
+    download the history only once, request the widest window first.
     """
+    oldtimestamp = mw_timestamp(oldtimestamp)
+    newtimestamp = mw_timestamp(newtimestamp)
+
+    with _run_cache_lock:
+        cached = _run_cache['history'].get(pagename)
+    if cached and cached['old'] <= oldtimestamp \
+            and cached['new'] >= newtimestamp \
+            and cached['maxcontinuenumber'] >= maxcontinuenumber:
+        return [rev for rev in cached['revs']
+                if oldtimestamp <= mw_timestamp(rev['timestamp'])
+                <= newtimestamp]
+
     # Per https://www.mediawiki.org/wiki/API:Revisions, rvstart is newer
     # than rvend if we list in reverse chronological order
     # (newer revisions first), i.e. "end" and "start" refer to the list.
-    oldtimestamp = UTC_timestamp_x_days_ago(days_offset=ndays)
-    currenttimestamp = UTC_timestamp_x_days_ago(days_offset=0)
-    revs = get_revisions_from_api(pagename, oldtimestamp, currenttimestamp,
+    revs = get_revisions_from_api(pagename, oldtimestamp, newtimestamp,
                                   maxcontinuenumber=maxcontinuenumber)
 
-    return revs
+    with _run_cache_lock:
+        cached = _run_cache['history'].get(pagename)
+        if not cached or (cached['old'] >= oldtimestamp
+                          and cached['new'] <= newtimestamp):
+            _run_cache['history'][pagename] = {
+                'old': oldtimestamp,
+                'new': newtimestamp,
+                'maxcontinuenumber': maxcontinuenumber,
+                'revs': revs,
+            }
+
+    return list(revs)
+
+
+def revisions_since_x_days(pagename, ndays, maxcontinuenumber=0):
+    """Get revision data for a given page for the last n days.
+
+    Input:
+    - pagename (string), the name of the page
+    - ndays (int or float): lookup revisions of the last ndays days
+    - maxcontinuenumber (int): recursion limit for API calls
+    Output: a list of dict (cf. get_revisions_from_api).
+
+    Cf. revisions_in_window, which serves the history of the run.
+    """
+    oldtimestamp = UTC_timestamp_x_days_ago(days_offset=ndays)
+    currenttimestamp = UTC_timestamp_x_days_ago(days_offset=0)
+    return revisions_in_window(pagename, oldtimestamp, currenttimestamp,
+                               maxcontinuenumber=maxcontinuenumber)
 
 
 def es_created_newsection(editsummary):  # noqa: D301
@@ -659,16 +1663,40 @@ def es_created_newsection(editsummary):  # noqa: D301
 
 
 def newsections_at_teahouse(ndays=10, thname='Wikipedia:Teahouse',
-                            maxcontinuenumber=0):
+                            maxcontinuenumber=0, window=None):
     """Get 'new section' creations at Teahouse in the last few days.
 
     Optional arguments:
     - ndays (10): (int or float) timeframe in days of revision to pull
     - thname: (string) name of the page whose revisions to pull
     - maxcontinuenumber: (int) recursion limit for API calls
+    - window: (oldtimestamp, newtimestamp) tuple, cf. lookback_window; if
+      given, it is used instead of ndays
+
+    Doctests (offline: the history view is filled with a fixture):
+    >>> reset_run_cache()
+    >>> _run_cache['history']['Wikipedia:Teahouse'] = {
+    ...     'old': '20180301000000', 'new': '20180311000000',
+    ...     'maxcontinuenumber': 0, 'revs': [
+    ...         {'revid': 3, 'user': 'Baz',
+    ...          'timestamp': '2018-03-10T00:00:00Z',
+    ...          'comment': '/* Later */ new section'},
+    ...         {'revid': 2, 'user': 'Foo',
+    ...          'timestamp': '2018-03-05T00:00:00Z',
+    ...          'comment': '/* Help */ new section'},
+    ...         {'revid': 1, 'user': 'Bar',
+    ...          'timestamp': '2018-03-04T00:00:00Z',
+    ...          'comment': '/* Help */ reply'}]}
+    >>> newsections_at_teahouse(window=('20180301000000', '20180308000000'))
+    [{'revid': 2, 'name': 'Help', 'user': 'Foo'}]
+    >>> reset_run_cache()
     """
-    rev_table = revisions_since_x_days(thname, ndays,
-                                       maxcontinuenumber=maxcontinuenumber)
+    if window:
+        rev_table = revisions_in_window(thname, window[0], window[1],
+                                        maxcontinuenumber=maxcontinuenumber)
+    else:
+        rev_table = revisions_since_x_days(thname, ndays,
+                                           maxcontinuenumber=maxcontinuenumber)
     output = []
     for rev in rev_table:
         editsummary = rev['comment']
@@ -683,6 +1711,75 @@ def newsections_at_teahouse(ndays=10, thname='Wikipedia:Teahouse',
     return output
 
 
+def parse_archival_edit(rev, archiver):
+    """Extract the archival information from an archival edit.
+
+    Input:
+    - rev: (dict) a revision, as output by get_revisions_from_api
+    - archiver: (string) username of the archival bot
+
+    Output: dict describing the archival edit.
+
+    Doctests:
+    >>> parse_archival_edit({'revid': 2, 'parentid': 1,
+    ...                      'timestamp': '2018-03-04T15:30:31Z',
+    ...                      'comment': 'Archiving 2 discussions to '
+    ...                                 '[[Wikipedia:Teahouse/Questions/'
+    ...                                 'Archive 98]]'},
+    ...                     'Lowercase sigmabot III')['links']
+    ['Wikipedia:Teahouse/Questions/Archive 98']
+    """
+    es = rev['comment']  # extract edit summary
+    # Determine archive locations from edit summary.
+    # Beware! The edit summary may contain multiple wikilinks.
+    # See for instance
+    # https://en.wikipedia.org/w/index.php?title=Wikipedia%3ATeahouse&type=revision&diff=783570477&oldid=783564581
+    # We need to match non-greedily and find all such links.
+    pattern = r'(\[\[.*?\]\])'
+    links = re.findall(pattern, es)
+
+    if not links:  # sanity check that at least one match was found
+        # Not fatal: threads can still be found in the archive index
+        logging.warning('Archival edit summary does not contain any '
+                        + 'wikilink: "{es}"'.format(es=es))
+
+    # strip brackets in links
+    strippedlinks = [l[2:-2] for l in links]
+
+    # save relevant edit information
+    output = {'after': rev['revid'],
+              'before': rev['parentid'],
+              'timestamp': rev['timestamp'],
+              'links': strippedlinks,
+              'es': es,                 # for debugging purposes
+              'archiver': archiver,  # same (not used as of 2018-03-18)
+              }
+    return output
+
+
+def archival_edits(maxdays=1, thname='Wikipedia:Teahouse',
+                   archiver='Lowercase sigmabot III', maxcontinuenumber=0):
+    """Parse page history for all archival edits.
+
+    Input:
+    - maxdays (int) the timeframe in days to look for archival edits
+    - thname (string) title of the page to look at
+    - archiver (string) username of the archival bot
+    - maxcontinuenumber (int): recursion limit for API calls
+
+    Output: list of dict describing the archival edits (cf.
+    parse_archival_edit), newest first.
+    """
+    rev_table = revisions_since_x_days(thname, maxdays,
+                                       maxcontinuenumber=maxcontinuenumber)
+    return [parse_archival_edit(rev, archiver) for rev in rev_table
+            if rev['user'] == archiver]
+
+
+class NoArchivalEdit(ValueError):
+    """No archival edit was made in the timeframe (cf. last_archival_edit)."""
+
+
 def last_archival_edit(maxdays=1, thname='Wikipedia:Teahouse',
                        archiver='Lowercase sigmabot III'):
     """Parse page history for last archival edit.
@@ -692,51 +1789,515 @@ def last_archival_edit(maxdays=1, thname='Wikipedia:Teahouse',
     - thname (string) title of the page to look at
     - archiver (string) username of the archival bot
 
-    Output: dict describing the last archival edit.
+    Output: dict describing the last archival edit. NoArchivalEdit is
+    raised if there is none in the timeframe.
     """
     rev_table = revisions_since_x_days(thname, maxdays)
-    found_flag = False
     for rev in rev_table:
         if rev['user'] == archiver:  # we found an archival edit
-            es = rev['comment']  # extract edit summary
-            # Determine archive locations from edit summary.
-            # Beware! The edit summary may contain multiple wikilinks.
-            # See for instance
-            # https://en.wikipedia.org/w/index.php?title=Wikipedia%3ATeahouse&type=revision&diff=783570477&oldid=783564581
-            # We need to match non-greedily and find all such links.
-            pattern = r'(\[\[.*?\]\])'
-            links = re.findall(pattern, es)
-
-            if not links:  # sanity check that at least one match was found
-                raise ValueError('Archival edit summary does not contain'
-                                 + 'any wikilink.', es)
-
-            # strip brackets in links
-            strippedlinks = [l[2:-2] for l in links]
-
-            # save relevant edit information
-            output = {'after': rev['revid'],
-                      'before': rev['parentid'],
-                      'links': strippedlinks,
-                      'es': es,                 # for debugging purposes
-                      'archiver': archiver,  # same (not used as of 2018-03-18)
-                      }
-            found_flag = True
-            break
-    if not found_flag:
-        raise ValueError('No edit by {arc} '.format(arc=archiver)
+            return parse_archival_edit(rev, archiver)
+
+    raise NoArchivalEdit('No edit by {arc} '.format(arc=archiver)
                          + 'found in the last {n} days'.format(n=maxdays),
                          rev_table)
-    return output
 
 
-def generate_notification_list():
+# Open-thread registry
+# Persistent record of the threads currently open on the board, with their
+# creator, built incrementally from the page history: a thread is added when
+# its 'new section' edit is seen, and moved to the archived threads of an
+# archival edit when that edit removes it. The creators of the threads of an
+# archival edit are then a direct lookup, without any history scan and
+# without lookback limit (cf. doc/known-issues.txt, "long-lived threads").
+REGISTRY_FILE = 'teahouse-thread-registry.json'
+REGISTRY_MAX_ARCHIVALS = 50  # number of archival edits kept in the registry
+REGISTRY_MAX_AGE = 180  # days after which an open thread is forgotten
+
+
+def registry_load(path=REGISTRY_FILE):
+    """Load the open-thread registry (empty if the file does not exist).
+
+    Output: dict with the keys
+    - 'last_revid', 'last_timestamp': last revision processed (None if empty)
+    - 'open': dict thread name (stripped) -> list of creations, each a dict
+      with 'name', 'user', 'revid' and 'timestamp'
+    - 'archived': dict archival revid (as a string) -> list of creations of
+      the threads that edit archived
+    - 'unresolved': dict archival revid (as a string) -> names of the threads
+      that edit archived but that were not found in the registry
+    """
+    try:
+        with open(path, encoding='utf-8') as f:
+            registry = json.load(f)
+    except FileNotFoundError:
+        registry = {'last_revid': None, 'last_timestamp': None,
+                    'open': {}, 'archived': {}}
+    registry.setdefault('unresolved', {})  # absent from older files
+    return registry
+
+
+def registry_apply(registry, revisions, archiver='Lowercase sigmabot III',
+                   removed_sections=None, fuzzy_threshold=None):
+    """Update the open-thread registry with new revisions of the board.
+
+    Input:
+    - registry: cf. registry_load; updated in place
+    - revisions: list of dict (cf. get_revisions_from_api), newest first as
+      returned by the API; those already processed are skipped
+    - archiver: (string) username of the archival bot
+    - removed_sections: function (revid before, revid after) -> names of the
+      removed threads; defaults to sections_removed_by_diff
+    - fuzzy_threshold: if given, a removed thread not found by its exact name
+      is matched to the only open thread with a similar enough name, e.g. if
+      its heading was edited (cf. fuzzy_lookup)
+
+    An archival edit whose removed threads cannot be determined (e.g. the
+    diff check of sections_removed_by_diff fails) is logged and skipped: it
+    is not recorded in 'archived', so that its creations are searched in the
+    page history instead (cf. registry_creations).
+
+    Doctests:
+    >>> registry = {'last_revid': None, 'last_timestamp': None,
+    ...             'open': {}, 'archived': {}, 'unresolved': {}}
+    >>> registry_apply(registry, [
+    ...     {'revid': 3, 'parentid': 2, 'user': 'Lowercase sigmabot III',
+    ...      'timestamp': '2018-03-03T00:00:00Z', 'comment': '[[Archive]]'},
+    ...     {'revid': 2, 'parentid': 1, 'user': 'Bar',
+    ...      'timestamp': '2018-03-02T00:00:00Z',
+    ...      'comment': '/* Other */ new section'},
+    ...     {'revid': 1, 'parentid': 0, 'user': 'Foo',
+    ...      'timestamp': '2018-03-01T00:00:00Z',
+    ...      'comment': '/* Help */ new section'}],
+    ...     removed_sections=lambda before, after: ['Help'])
+    >>> [c['user'] for c in registry['archived']['3']]
+    ['Foo']
+    >>> sorted(registry['open']), registry['last_revid']
+    (['Other'], 3)
+    >>> def diff_fails(before, after):
+    ...     raise AssertionError('not a single removal')
+    >>> registry_apply(registry, [
+    ...     {'revid': 4, 'parentid': 3, 'user': 'Lowercase sigmabot III',
+    ...      'timestamp': '2018-03-04T00:00:00Z', 'comment': '[[Archive]]'}],
+    ...     removed_sections=diff_fails)
+    >>> '4' in registry['archived'], registry['last_revid']
+    (False, 4)
+    >>> registry_apply(registry, [
+    ...     {'revid': 5, 'parentid': 4, 'user': 'Lowercase sigmabot III',
+    ...      'timestamp': '2018-03-05T00:00:00Z', 'comment': '[[Archive]]'}],
+    ...     removed_sections=lambda before, after: ['Other!', 'Unknown'],
+    ...     fuzzy_threshold=0.6)
+    >>> [c['user'] for c in registry['archived']['5']], registry['open']
+    (['Bar'], {})
+    >>> registry['unresolved']['5']
+    ['Unknown']
+    """
+    if removed_sections is None:
+        removed_sections = sections_removed_by_diff
+
+    for rev in reversed(revisions):  # oldest first
+        if registry['last_revid'] is not None \
+                and rev['revid'] <= registry['last_revid']:
+            continue
+
+        newsection_created = es_created_newsection(rev['comment'])
+        if newsection_created['flag']:
+            name = newsection_created['name']
+            registry['open'].setdefault(name.strip(), []).append(
+                {'name': name, 'user': rev['user'], 'revid': rev['revid'],
+                 'timestamp': rev['timestamp']})
+        elif rev['user'] == archiver:
+            try:
+                removed = removed_sections(rev['parentid'], rev['revid'])
+            except DeadlineExceeded:
+                raise
+            except Exception:
+                logging.warning('Threads archived by revision '
+                                + '{r} could not be '.format(r=rev['revid'])
+                                + 'determined; they will be searched in the '
+                                + 'page history.', exc_info=True)
+                removed = None
+            if removed is not None:
+                registry_archive(registry, rev['revid'], removed,
+                                 fuzzy_threshold=fuzzy_threshold)
+
+        registry['last_revid'] = rev['revid']
+        registry['last_timestamp'] = rev['timestamp']
+
+    # Keep the registry small
+    for oldkey in sorted(registry['archived'], key=int)[
+            :-REGISTRY_MAX_ARCHIVALS]:
+        del registry['archived'][oldkey]
+        registry['unresolved'].pop(oldkey, None)
+
+
+def registry_archive(registry, revid, removed, fuzzy_threshold=None):
+    """Move the threads removed by an archival edit out of the open threads.
+
+    Input: cf. registry_apply; revid is the archival revid and removed the
+    names of the threads it removed.
+    """
+    archived = []
+    unresolved = []
+    for name in removed:
+        if name.strip() in registry['open']:
+            archived += registry['open'].pop(name.strip())
+        else:
+            unresolved.append(name)
+
+    if unresolved and fuzzy_threshold is not None:
+        missing = unresolved
+        unresolved = []
+        for name in missing:
+            opennames = list(registry['open'])
+            matches = fuzzy_lookup(ngram_index(opennames), name,
+                                   fuzzy_threshold)
+            if len(matches) == 1:
+                logging.info('Fuzzy match for archived thread '
+                             + '"{tn}": "{on}"'.format(
+                                 tn=name, on=opennames[matches[0]]))
+                archived += registry['open'].pop(opennames[matches[0]])
+            else:
+                unresolved.append(name)
+
+    registry['archived'][str(revid)] = archived
+    if unresolved:
+        registry['unresolved'][str(revid)] = unresolved
+
+
+def registry_update(registry, thname='Wikipedia:Teahouse',
+                    archiver='Lowercase sigmabot III', bootstrap_days=10,
+                    mindays=1, maxcontinuenumber=50, fuzzy_threshold=None):
+    """Bring the open-thread registry up to date from the page history.
+
+    Input:
+    - registry: cf. registry_load; updated in place
+    - thname, archiver: cf. last_archival_edit
+    - bootstrap_days: history pulled to fill an empty registry
+    - mindays: the history pulled covers at least that many days, so that
+      other readers of the recent history (cf. last_archival_edit) are
+      served by the run-scoped history view
+    - maxcontinuenumber: (int) recursion limit for API calls
+    - fuzzy_threshold: cf. registry_apply
+
+    Open threads older than REGISTRY_MAX_AGE days are dropped (removed
+    without archival, or missed).
+    """
+    newtimestamp = UTC_timestamp_x_days_ago(days_offset=0)
+    oldtimestamp = UTC_timestamp_x_days_ago(days_offset=mindays)
+    if registry['last_timestamp'] is None:
+        oldtimestamp = UTC_timestamp_x_days_ago(days_offset=bootstrap_days)
+    else:
+        oldtimestamp = min(oldtimestamp,
+                           mw_timestamp(registry['last_timestamp']))
+
+    revs = revisions_in_window(thname, oldtimestamp, newtimestamp,
+                               maxcontinuenumber=maxcontinuenumber)
+    registry_apply(registry, revs, archiver=archiver,
+                   fuzzy_threshold=fuzzy_threshold)
+
+    cutoff = UTC_timestamp_x_days_ago(days_offset=REGISTRY_MAX_AGE)
+    for name in list(registry['open']):
+        entries = [e for e in registry['open'][name]
+                   if mw_timestamp(e['timestamp']) >= cutoff]
+        if entries:
+            registry['open'][name] = entries
+        else:
+            del registry['open'][name]
+
+
+def registry_creations(registry, lae):
+    """Get the creations of the threads archived by an archival edit.
+
+    Output: list of dict in the format of newsections_at_teahouse, or None
+    if the registry did not process that archival edit. Threads of that edit
+    that were not found in the registry are listed in
+    registry['unresolved'].
+    """
+    archived = registry['archived'].get(str(lae['after']))
+    if archived is None:
+        return None
+    return [{'revid': c['revid'], 'name': c['name'], 'user': c['user']}
+            for c in archived]
+
+
+def get_section0_wikitext(revid, site=pywikibot.Site()):
+    """Get the wikitext of the lead section of a page revision.
+
+    Input: revid (int), a revision number.
+    Output: string, the wikitext of section 0 (before the first heading).
+    """
+    if _dump is not None:
+        return wikitext_section0(dump_revision_text(revid))
+
+    api_call_result = manual_API_call(site, action='query', prop='revisions',
+                                      revids=revid, rvprop='content',
+                                      rvslots='main', rvsection=0,
+                                      format='json', formatversion=2)
+    revision = api_call_result['query']['pages'][0]['revisions'][0]
+    if 'slots' in revision:
+        return revision['slots']['main']['content']
+    return revision['content']
+
+
+def parse_archiver_config(wikitext):
+    """Parse the archiver configuration template of a page.
+
+    Input: wikitext (string) containing the {{User:MiszaBot/config}}
+    template read by the archival bot.
+
+    Output: dict with the keys 'age_days' (float, cf. the algo=old(...)
+    parameter), 'counter' (int or None) and 'archive' (string or None); or
+    None if no configuration (or no age setting) was found.
+
+    Doctests:
+    >>> config = parse_archiver_config('''{{User:MiszaBot/config
+    ... |archiveheader = {{Teahouse archive header}}
+    ... |maxarchivesize = 300K
+    ... |counter = 812
+    ... |algo = old(36h)
+    ... |archive = Wikipedia:Teahouse/Questions/Archive %(counter)d
+    ... }}''')
+    >>> config['age_days'], config['counter']
+    (1.5, 812)
+    >>> config['archive']
+    'Wikipedia:Teahouse/Questions/Archive %(counter)d'
+    >>> parse_archiver_config('No configuration here') is None
+    True
+    >>> parse_archiver_config('{{User:MiszaBot/config|algo=old(2d)}}\\n'
+    ...                       '{{Other|algo=old(9d)|counter=3}}')['age_days']
+    2.0
+    """
+    start = re.search(r'\{\{\s*User:MiszaBot/config', wikitext, re.IGNORECASE)
+    if not start:
+        return None
+    # Only the parameters of the template itself: the text of nested
+    # templates (e.g. archiveheader) and what follows the template are left
+    # out
+    parts = []
+    depth = 1
+    pos = start.end()
+    for brace in re.finditer(r'\{\{|\}\}', wikitext[pos:]):
+        if depth == 1:
+            parts.append(wikitext[pos:start.end() + brace.start()])
+        depth += 1 if brace.group() == '{{' else -1
+        pos = start.end() + brace.end()
+        if depth == 0:
+            break
+    else:  # template not closed
+        parts.append(wikitext[pos:])
+    # Parameters end at the next pipe or at the end of the line
+    config = ''.join(parts)
+
+    algo = re.search(r'\|\s*algo\s*=\s*old\(\s*(\d+(?:\.\d+)?)\s*([hdw])\s*\)',
+                     config)
+    if not algo:
+        return None
+    days_per_unit = {'h': 1 / 24, 'd': 1, 'w': 7}
+    age_days = float(algo.group(1)) * days_per_unit[algo.group(2)]
+
+    counter = re.search(r'\|\s*counter\s*=\s*(\d+)', config)
+    archive = re.search(r'\|\s*archive\s*=\s*([^|\n]*?)\s*(?:\||\n|$)',
+                        config)
+    return {'age_days': age_days,
+            'counter': int(counter.group(1)) if counter else None,
+            'archive': archive.group(1) if archive else None,
+            }
+
+
+def lookback_window(config, archival_timestamp, ndays=10):
+    """Compute the history window to search for thread creations.
+
+    Input:
+    - config: dict from parse_archiver_config, or None
+    - archival_timestamp: (string) timestamp of the archival edit
+    - ndays: (int or float) maximum lookback before the archival edit
+
+    Output: (oldtimestamp, newtimestamp) tuple, in Mediawiki format.
+
+    A thread archived by an edit had no activity for at least the age set in
+    the archiver configuration, so it was created at least that long before
+    the archival edit. Searching the history up to the archival edit minus
+    that age (cf. doc/known-issues.txt, "cross-archival") pulls less history
+    and avoids matching a more recent thread of the same name. If config is
+    None, the window ends at the archival edit.
+
+    Doctests:
+    >>> lookback_window({'age_days': 1.5}, '2018-03-11T12:00:00Z')
+    ('20180301120000', '20180310000000')
+    >>> lookback_window(None, '2018-03-11T12:00:00Z', ndays=2)
+    ('20180309120000', '20180311120000')
+    """
+    archival_time = datetime.datetime.strptime(
+        mw_timestamp(archival_timestamp), '%Y%m%d%H%M%S')
+    age_days = config['age_days'] if config else 0
+    oldtime = archival_time - datetime.timedelta(days=ndays)
+    newtime = archival_time - datetime.timedelta(days=min(age_days, ndays))
+    return (oldtime.strftime('%Y%m%d%H%M%S'),
+            newtime.strftime('%Y%m%d%H%M%S'))
+
+
+def archiver_config(revid):
+    """Get the archiver configuration at a revision of the page.
+
+    Output: cf. parse_archiver_config, for the lead section of revision
+    revid. It is read once per run (cf. run_cached), however many stages
+    need it.
+    """
+    return run_cached('config', revid, lambda: parse_archiver_config(
+        get_section0_wikitext(revid)))
+
+
+def archival_lookback_window(lae, ndays=10):
+    """Get the history window to search for creations of archived threads.
+
+    Input:
+    - lae: dict describing the archival edit, cf. parse_archival_edit
+    - ndays: cf. lookback_window
+
+    The archiver configuration is read in the lead section of the page just
+    before the archival edit (i.e. the settings the archival bot used), cf.
+    archiver_config. If it cannot be read, the window falls back to the
+    ndays before the archival edit.
+    """
+    config = archiver_config(lae['before'])
+    if config is None:
+        logging.warning('No archiver configuration found at revision '
+                        + '{r}; '.format(r=lae['before'])
+                        + 'searching the full lookback window.')
+
+    window = lookback_window(config, lae['timestamp'], ndays=ndays)
+    logging.info('Searching thread creations between {0} and {1}.'.format(
+        *window))
+    return window
+
+
+def run_stages(stages, max_workers=4, allow_partial=False, on_done=None):
+    """Run a small DAG of stages concurrently, respecting dependencies.
+
+    Input:
+    - stages: dict whose keys are stage names and whose values are tuples
+      (deps, func), where deps is a list of stage names that must complete
+      first and func is a callable taking a single argument, the dict of
+      results of the stages completed so far (keyed by stage name)
+    - max_workers: (int) maximum number of stages running at the same time
+    - allow_partial: (bool) cf. below
+    - on_done: if given, called as on_done(name) after each stage completes,
+      in the calling thread; it may raise to stop the run like a stage
+
+    Output: dict of results, keyed by stage name.
+
+    A stage is submitted as soon as all of its dependencies are done, so the
+    total run time is that of the critical path rather than the sum of all
+    stages. If a stage raises, the exception is propagated once the stages
+    already running have finished; stages not yet started are skipped.
+
+    If the run deadline is reached (cf. set_run_deadline), no stage is
+    started anymore and DeadlineExceeded is raised; with allow_partial, the
+    results of the completed stages are returned instead. Stages still
+    running are abandoned (their API calls time out on their own).
+
+    Doctests:
+    >>> run_stages({'a': ([], lambda r: 1),
+    ...             'b': ([], lambda r: 2),
+    ...             'c': (['a', 'b'], lambda r: r['a'] + r['b'])})['c']
+    3
+    >>> run_stages({'a': (['b'], lambda r: 1), 'b': (['a'], lambda r: 2)})
+    Traceback (most recent call last):
+      (some traceback)
+    ValueError: ('Stage dependencies cannot be resolved.', ['a', 'b'])
+    """
+    for name, (deps, func) in stages.items():
+        unknown = [d for d in deps if d not in stages]
+        if unknown:
+            raise ValueError('Stage "{s}" depends on '.format(s=name)
+                             + 'unknown stages.', unknown)
+
+    results = dict()
+    pending = dict(stages)  # stages not submitted yet
+    running = dict()  # future -> stage name
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    abandon = False  # if True, do not wait for the stages still running
+    try:
+        while pending or running:
+            ready = [name for name, (deps, func) in pending.items()
+                     if all(d in results for d in deps)]
+            for name in ready:
+                func = pending.pop(name)[1]
+                # Pass a snapshot so that stages never see a dict in flux
+                running[ex.submit(func, dict(results))] = name
+
+            if not running:  # nothing can run and nothing will finish
+                raise ValueError('Stage dependencies cannot be resolved.',
+                                 sorted(pending))
+
+            left = time_left()
+            done, _ = concurrent.futures.wait(
+                running, timeout=None if left is None else max(0, left),
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:  # deadline reached while waiting
+                raise DeadlineExceeded('Run deadline reached.')
+            for future in done:
+                name = running.pop(future)
+                # .result() re-raises the stage exception, if any; the
+                # other running stages are waited for below
+                results[name] = future.result()
+                if on_done is not None:
+                    on_done(name)
+    except DeadlineExceeded:
+        abandon = True
+        if not allow_partial:
+            raise
+        logging.warning('Run deadline reached; stages not completed: '
+                        + ', '.join(sorted(set(pending)
+                                           | set(running.values()))))
+        return results
+    finally:
+        ex.shutdown(wait=not abandon)
+
+    return results
+
+
+def generate_notification_list(max_workers=4, fuzzy_threshold=None,
+                               lae=None, archive_index_path=None,
+                               registry_path=None, on_stage=None):
     """Make list of notifications to make.
 
     This function makes all the API read calls necessary to determine which
     threads have been last archived, which users started them, and whether
     those users are eligible to receive a notification.
 
+    The read calls are organized as a DAG of stages (cf. run_stages), so that
+    independent calls run concurrently, at most max_workers at a time:
+
+        [registry] --> last archival edit --+--> removed sections --+
+                                            |                       |
+                                            +--> thread creations --+
+                                                                    |
+                                                     matching <-----+ ...
+
+        ... matching --+--> archive link search
+                       +--> user eligibility
+
+    By default, the last archival edit is processed; lae can be given instead
+    (cf. parse_archival_edit) to process an older one, e.g. a queued job.
+
+    If fuzzy_threshold is given, thread titles that were slightly edited
+    between creation and archival are matched by similarity (cf.
+    list_matching and search_archives_for_section).
+
+    If archive_index_path is given, the archive index stored there is used
+    to find threads missing from the archive links, and kept up to date.
+
+    If registry_path is given, the open-thread registry stored there is
+    brought up to date, and the creators of the archived threads are looked
+    up in it (cf. registry_creations). Otherwise, or if the registry did not
+    see the archival edit, new section creations are searched in a window
+    ending before the archival edit, derived from the archiver configuration
+    (cf. archival_lookback_window).
+
+    on_stage is passed to run_stages (on_done), e.g. to renew a job lease
+    between stages.
+
     The output is a list of dict, each containing the keys:
     - 'user'    - username of thread started
     - 'tn'      - thread name
@@ -745,45 +2306,157 @@ def generate_notification_list():
     - 'archivelink' - a link to the archived thread (with anchor), if found
     - 'reason'      - if 'invalid' is True, explains why
     """
-    # Get last archival edit
-    lae = last_archival_edit()
-    idbefore = lae['before']
-    idafter = lae['after']
-    # Sections from last archival edit
-    archived_sections = sections_removed_by_diff(idbefore, idafter)
-
-    # New section creations in recent days from page history
     maxpagestopull = 5
-    nscreated = newsections_at_teahouse(maxcontinuenumber=maxpagestopull)
-
-    # List of threads that were archived in last archival edit, which
-    # could be matched to their creation in the last few days
-    thread_matched = list_matching(archived_sections, nscreated)
-    thread_matched_names = [thread['name'] for thread in thread_matched]
-    thread_matched_users = [thread['user'] for thread in thread_matched]
-
-    # For those, try and recover the corresponding archival link
-    # (including anchor)
-    possible_archive_links = lae['links']
-    list_of_archive_links = search_archives_for_section(possible_archive_links,
-                                                        thread_matched_names)
+    thname = 'Wikipedia:Teahouse'
+    maxdays = 10  # maximum lookback, cf. lookback_window
+
+    def stage_archived(r):
+        # Sections from last archival edit
+        return sections_removed_by_diff(r['lae']['before'], r['lae']['after'])
+
+    def stage_registry(r):
+        with file_lock(registry_path):
+            registry = registry_load(registry_path)
+            registry_update(registry, thname=thname,
+                            fuzzy_threshold=fuzzy_threshold)
+            save_json_atomically(registry, registry_path)
+        return registry
+
+    def stage_nscreated(r):
+        creations = None
+        if r.get('registry'):
+            revid = r['lae']['after']
+            creations = registry_creations(r['registry'], r['lae'])
+            if creations is None:
+                logging.info('Archival edit {r} not in the '.format(r=revid)
+                             + 'registry; searching the history.')
+            elif not r['registry']['unresolved'].get(str(revid)):
+                return creations
+            else:
+                logging.info('Some threads of archival edit {r} '.format(
+                    r=revid) + 'not in the registry; searching the history.')
+        # History window that can contain the creations of archived threads
+        window = archival_lookback_window(r['lae'], ndays=maxdays)
+        # New section creations in that window from page history
+        found = newsections_at_teahouse(thname=thname,
+                                        maxcontinuenumber=maxpagestopull,
+                                        window=window)
+        if not creations:
+            return found
+        known = {c['revid'] for c in creations}
+        return creations + [c for c in found if c['revid'] not in known]
+
+    def stage_matched(r):
+        # List of threads that were archived in last archival edit, which
+        # could be matched to their creation in the last few days
+        return list_matching(r['archived'], r['nscreated'],
+                             fuzzy_threshold=fuzzy_threshold)
+
+    def stage_links(r):
+        # For those, try and recover the corresponding archival link
+        # (including anchor)
+        names = [thread['name'] for thread in r['matched']]
+        if not archive_index_path:
+            return search_archives_for_section(
+                r['lae']['links'], names, fuzzy_threshold=fuzzy_threshold)
+
+        # The threads were archived to the archive in use before the edit,
+        # or to a later one if it became full
+        config = archiver_config(r['lae']['before'])
+        min_archive = config['counter'] if config else None
+        if min_archive is None:
+            logging.warning('Archive counter unknown at revision '
+                            + '{r}; '.format(r=r['lae']['before'])
+                            + 'the archive index will not be searched.')
+        with file_lock(archive_index_path):
+            archive_index = archive_index_load(archive_index_path)
+            links = search_archives_for_section(
+                r['lae']['links'], names, fuzzy_threshold=fuzzy_threshold,
+                archive_index=archive_index, min_archive=min_archive)
+            save_json_atomically(archive_index, archive_index_path)
+        return links
+
+    def stage_notifiable(r):
+        # Check if user can be notified
+        return isnotifiable([thread['user'] for thread in r['matched']])
+
+    # With a registry, its update pulls the recent history first, and the
+    # last archival edit is then found from the run-scoped history view
+    registry_stage = ['registry'] if registry_path else []
+    stages = {
+        # Get last archival edit
+        'lae': (registry_stage, lambda r: lae or last_archival_edit(
+            thname=thname)),
+        'archived': (['lae'], stage_archived),
+        # Creations of the archived threads
+        'nscreated': (['lae'] + registry_stage, stage_nscreated),
+        'matched': (['archived', 'nscreated'], stage_matched),
+        'links': (['lae', 'matched'], stage_links),
+        'notifiable': (['matched'], stage_notifiable),
+    }
+    if registry_path:
+        stages['registry'] = ([], stage_registry)
+    results = run_stages(stages, max_workers=max_workers, allow_partial=True,
+                         on_done=on_stage)
+
+    if 'matched' not in results:
+        # Nothing proven yet; the archival edit (if known) is deferred
+        raise DeadlineExceeded('Run deadline reached before matching.',
+                               results.get('lae'))
+
+    return build_notification_list(results['matched'], results['lae']['links'],
+                                   results.get('links'),
+                                   results.get('notifiable'))
+
+
+def build_notification_list(thread_matched, links_searched,
+                            list_of_archive_links, is_notifiable):
+    """Assemble the notification list from the read results.
 
-    # Check if user can be notified
-    is_notifiable = isnotifiable(thread_matched_users)
+    Input:
+    - thread_matched: list of dict, each with at least 'name' (thread name)
+      and 'user' (thread starter), cf. list_matching
+    - links_searched: list of strings, the archive links searched for those
+      threads (only kept in deferred notifications)
+    - list_of_archive_links: output of search_archives_for_section for the
+      threads, or None if not available (run deadline reached)
+    - is_notifiable: output of isnotifiable for the users, or None if not
+      available (run deadline reached)
+
+    Output: cf. generate_notification_list. If some read results are not
+    available, the notifications are 'invalid' and 'deferred', and keep
+    what is needed to complete them in a later run (cf. resume_deferred).
 
-    # Generate notification list
-    N = len(list_of_archive_links)
+    Doctests:
+    >>> build_notification_list([{'name': 'Foo', 'user': 'Bar'}], ['A'],
+    ...                         ['A#Foo'], {'Bar': True})[0]['archivelink']
+    'A#Foo'
+    >>> build_notification_list([{'name': 'Foo', 'user': 'Bar'}], ['A'],
+    ...                         ['A#Foo'], None)[0]['deferred']
+    True
+    """
     notification_list = list()
-    for i in range(N):
-        username = thread_matched_users[i]
-        tn = thread_matched_names[i]
-        al = list_of_archive_links[i]
+    for i, thread in enumerate(thread_matched):
+        username = thread['user']
+        tn = thread['name']
 
         notif = {'user': username,
                  'thread': tn,
                  'invalid': False,
                  }
 
+        if list_of_archive_links is None or is_notifiable is None:
+            notif['invalid'] = True
+            notif['deferred'] = True
+            notif['reason'] = 'run deadline reached, deferred to next run'
+            notif['links'] = links_searched
+            if list_of_archive_links and list_of_archive_links[i]:
+                notif['archivelink'] = list_of_archive_links[i]
+            notification_list.append(notif)
+            continue
+
+        al = list_of_archive_links[i]
+
         if al:
             notif['archivelink'] = al
         else:
@@ -801,12 +2474,169 @@ def generate_notification_list():
     return notification_list
 
 
-def notify(user, argstr, testlvl):
+# Deferred work
+# What a test run could not complete before the run deadline is saved here
+# and picked up at the next test run (cf. main and resume_deferred).
+# Production runs use the work queue instead, where unfinished jobs are given
+# back (cf. run_worker), so test runs never take the work of production runs.
+# Deferred work that keeps failing is dropped after a few runs.
+DEFERRED_TEST_FILE = 'teahouse-deferred-test.json'
+DEFERRED_MAX_ATTEMPTS = 3
+
+
+def deferred_load(path=DEFERRED_TEST_FILE):
+    """Load the deferred work list (empty if the file does not exist)."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def resume_deferred(deferred, **kwargs):
+    """Complete deferred work from a previous run.
+
+    Input:
+    - deferred: list from deferred_load. Each item is either {'lae': ...}
+      (an archival edit not processed at all), {'since': timestamp} (all the
+      archival edits since then, when a run could not even find its own),
+      or a deferred notification (cf. build_notification_list)
+    - **kwargs: passed to generate_notification_list
+
+    Output: tuple (notification list, items still deferred). Missing archive
+    links are searched again, and the users' eligibility is always checked
+    again, since it may have changed since the previous run.
+
+    Each item is resumed on its own: an item that fails is kept for the next
+    run with its 'attempts' count increased (and dropped after
+    DEFERRED_MAX_ATTEMPTS failures), so that it never blocks the others.
+    Once the run deadline is reached, the items not done yet are kept as
+    they are.
+
+    Doctests:
+    >>> set_run_deadline(-1)
+    >>> resume_deferred([{'since': '2024-01-01T00:00:00Z'},
+    ...                  {'user': 'Foo', 'thread': 'Bar', 'links': []}])
+    ([], [{'since': '2024-01-01T00:00:00Z'}, \
+{'user': 'Foo', 'thread': 'Bar', 'links': []}])
+    >>> set_run_deadline(None)
+    >>> resume_deferred([{'lae': {'before': 1, 'after': 2, 'links': []},
+    ...                   'attempts': 1}],
+    ...                 max_workers=1)[1][0]['attempts']  # no API call
+    2
+    """
+    notification_list = []
+    kept = []
+    pending = []
+
+    def failed(item):
+        attempts = item.get('attempts', 0) + 1
+        if attempts >= DEFERRED_MAX_ATTEMPTS:
+            logging.error('Deferred work dropped after '
+                          + '{n} failed attempts: {i}'.format(n=attempts,
+                                                              i=item))
+            return
+        logging.warning('Deferred work failed, kept for next run: '
+                        + '{i}'.format(i=item), exc_info=True)
+        kept.append(dict(item, attempts=attempts))
+
+    items = list(deferred)
+    while items:
+        item = items.pop(0)
+        if 'lae' not in item and 'since' not in item:
+            pending.append(item)
+            continue
+        try:
+            check_deadline()
+            if 'lae' in item:
+                notification_list += generate_notification_list(
+                    lae=item['lae'], **kwargs)
+            else:
+                since = datetime.datetime.strptime(
+                    mw_timestamp(item['since']), '%Y%m%d%H%M%S')
+                ndays = (run_reference_time() - since).total_seconds() / 86400
+                # Each archival edit is then resumed (and may fail) on its own
+                items = [{'lae': lae} for lae in archival_edits(
+                    maxdays=ndays, maxcontinuenumber=5)] + items
+        except DeadlineExceeded:
+            return notification_list, kept + [item] + items + pending
+        except Exception:
+            failed(item)
+
+    resolved = []
+    archive_links = []
+    for i, item in enumerate(pending):
+        try:
+            if item.get('archivelink'):
+                archive_links.append(item['archivelink'])
+            else:
+                check_deadline()
+                archive_links += search_archives_for_section(
+                    item['links'], [item['thread']])
+            resolved.append(item)
+        except DeadlineExceeded:
+            kept += pending[i:]
+            break
+        except Exception:
+            failed(item)
+    if resolved:
+        try:
+            is_notifiable = isnotifiable(list({item['user']
+                                               for item in resolved}))
+        except DeadlineExceeded:
+            is_notifiable = None  # deferred again
+        except Exception:
+            for item in resolved:
+                failed(item)
+            resolved = []
+    if resolved:
+        threads = [{'name': item['thread'], 'user': item['user']}
+                   for item in resolved]
+        links = [link for item in resolved for link in item['links']]
+        notification_list += build_notification_list(
+            threads, links, archive_links, is_notifiable)
+
+    return notification_list, kept
+
+
+def notification_argstrs(user, threads, archive_from, botname):
+    """Format the arguments of the notification templates of a user.
+
+    Input:
+    - user: (string) username of the notified editor
+    - threads: list of (thread name, archive link) tuples, all the threads of
+      that user to include in a single notification edit
+    - archive_from, botname: cf. notify_all
+
+    Output: a list of strings of template arguments, one per thread. The
+    notification template only takes a single thread, so a user with
+    several threads gets one template (and section) per thread in the same
+    edit (cf. notification_text).
+
+    Doctests:
+    >>> notification_argstrs('Foo', [('Bar', 'A1#Bar')],
+    ...                      '[[Wikipedia:Teahouse]]', 'Muninnbot') == [
+    ...     'pagelinked=[[Wikipedia:Teahouse]]|threadname=Bar|'
+    ...     'archivelink=A1#Bar|botname=Muninnbot|editorname=Foo']
+    True
+    >>> len(notification_argstrs('Foo', [('Bar', 'A1#Bar'), ('Baz', 'A1#Baz')],
+    ...                          '[[Wikipedia:Teahouse]]', 'Muninnbot'))
+    2
+    """
+    formatspec = 'pagelinked={pl}|threadname={tn}|archivelink={al}|'\
+                 + 'botname={bn}|editorname={en}'
+    return [formatspec.format(pl=archive_from, tn=thread, al=archivelink,
+                              bn=botname, en=user)
+            for thread, archivelink in threads]
+
+
+def notify(user, argstrs, testlvl):
     """Post archival notification.
 
     Input:
     - user: (string) username, will post to User talk:<user>
-    - argstr: (string) contains arguments to pass to template
+    - argstrs: (list of strings) arguments to pass to template, one per
+      thread (cf. notification_argstrs); all are posted in a single edit
     - testlvl: (int) 0 for production, >=1 for various test levels
 
     No output to stdout, since this will cause posts on WP.
@@ -836,40 +2666,173 @@ def notify(user, argstr, testlvl):
         page = pywikibot.Page(site, 'User talk:' + user)
         sn = 'Your thread has been archived'
 
+    text = notification_text(argstrs, testlvl, sn)
+    save_new_section(site, page, text, sn)
+
+
+def notification_text(argstrs, testlvl, sn):
+    """Make the wikitext of a notification edit.
+
+    Input: cf. notify; sn is the section title. The text is saved as a new
+    section titled sn, which holds the first template; each further
+    template gets its own section with the same title.
+
+    Doctests:
+    >>> print(notification_text(['threadname=Foo', 'threadname=Bar'], 0,
+    ...                         'Your thread has been archived'))
+    {{subst:User:Muninnbot/Teahouse archival notification|threadname=Foo}}
+    <BLANKLINE>
+    == Your thread has been archived ==
+    {{subst:User:Muninnbot/Teahouse archival notification|threadname=Bar}}
+    """
     # 0 for production, all the rest creates a "this is in test phase" comment
     if testlvl > 0:
         test_comment = "</br><small>This functionality is currently under "\
                        + "test. If you received this notification by error, "\
                        + "please [[User talk:Tigraan|notify the bot's"\
                        + " maintainer]].</small>"
-        text = '{{subst:User:Muninnbot/Teahouse archival notification|'\
-               + argstr + '|additionaltext=' + test_comment + '}}'
+        templates = ['{{subst:User:Muninnbot/Teahouse archival '
+                     + 'notification|' + argstr + '|additionaltext='
+                     + test_comment + '}}' for argstr in argstrs]
     else:
-        text = '{{subst:User:Muninnbot/Teahouse archival notification|'\
-               + argstr + '}}'
+        templates = ['{{subst:User:Muninnbot/Teahouse archival '
+                     + 'notification|' + argstr + '}}' for argstr in argstrs]
+    return ('\n\n== ' + sn + ' ==\n').join(templates)
+
+
+def save_new_section(site, page, text, sn):
+    """Save text as a new section of page, with section title sn."""
+    page.save(text=text, summary=sn, section='new', minor=False,
+              botflag=True)
+
+
+# Test report
+# In the batch test modes, all notifications are rendered into one report,
+# written to the log page in a single edit ('test-batch') or to a local file
+# ('offlinetest-batch'), instead of one log page edit per notification.
+REPORT_FILE = 'THA-report.txt'
+# Delivery modes that do not edit the wiki (cf. notify_all)
+OFFLINE_STATUSES = ('offlinetest', 'offlinetest-batch')
 
-    page.save(text=text, summary=sn, section='new', minor=False, botflag=True)
+
+def render_test_report(entries):
+    """Render notifications into a single test report.
+
+    Input: entries is a list of (user, argstrs) tuples (cf. notify).
+    Output: string, the wikitext of the report; each notification is a
+    subsection titled with its intended recipient (one per thread).
+
+    Doctests:
+    >>> print(render_test_report([('Foo', ['threadname=Bar'])]))
+    === Notification intended for [[:en:User talk:Foo]] ===
+    {{subst:User:Muninnbot/Teahouse archival notification|threadname=Bar|additionaltext=</br><small>This functionality is currently under test. If you received this notification by error, please [[User talk:Tigraan|notify the bot's maintainer]].</small>}}
+    <BLANKLINE>
+    """  # noqa: E501
+    parts = []
+    for user, argstrs in entries:
+        sn = 'Notification intended for [[:en:User talk:' + user + ']]'
+        for argstr in argstrs:  # one subsection per thread, as in notify
+            parts.append('=== ' + sn + ' ===\n'
+                         + notification_text([argstr], 2, sn) + '\n')
+    return '\n'.join(parts)
+
+
+def deliver_test_report(entries, status, report_path=REPORT_FILE):
+    """Write the test report of entries (cf. render_test_report).
+
+    With status 'test-batch', the report is saved as a single new section of
+    User talk:Muninnbot/THA log; with 'offlinetest-batch', it is appended to
+    the local file report_path (e.g. one report per job of a worker). The
+    report title gives the number of notifications, i.e. of threads.
+
+    Doctests:
+    >>> path = os.path.join(tempfile.mkdtemp(), 'report.txt')
+    >>> deliver_test_report([('Foo', ['threadname=Bar', 'threadname=Baz'])],
+    ...                     'offlinetest-batch', report_path=path)
+    >>> with open(path, encoding='utf-8') as f:
+    ...     print(f.readline().strip())  # doctest: +ELLIPSIS
+    == Test run of ...: 2 notifications ==
+    >>> os.remove(path)
+    >>> os.rmdir(os.path.dirname(path))
+    """
+    report = render_test_report(entries)
+    sn = 'Test run of {ts}: {n} notifications'.format(
+        ts=UTC_timestamp_x_days_ago(days_offset=0),
+        n=sum(len(argstrs) for user, argstrs in entries))
+
+    if status == 'offlinetest-batch':
+        with open(report_path, 'a', encoding='utf-8') as f:
+            f.write('== ' + sn + ' ==\n' + report + '\n')
+        logging.info('Test report written to ' + report_path)
+    else:
+        site = pywikibot.Site('en', 'wikipedia')
+        page = pywikibot.Page(site, 'User talk:Muninnbot/THA log')
+        save_new_section(site, page, report, sn)
 
 
 def notify_all(notification_list, status,
                archive_from='[[Wikipedia:Teahouse]]',
-               botname='Muninnbot'):
+               botname='Muninnbot', skip_users=(), on_delivered=None,
+               report_path=REPORT_FILE, before_delivery=None):
     """Execute notification list.
 
     Input:
     - notification_list: cf. generate_notification_list for format
     - status: 'offlinetest' for printing to stdout, 'test-X' for various
-              testing levels, 'prod' for production use
+              testing levels, 'prod' for production use; 'test-batch' and
+              'offlinetest-batch' write all notifications in a single test
+              report (cf. deliver_test_report)
     - archive_from: original page of the thread (only for notification
                     formatting, not actually checked)
     - botname: name of the bot who leaves the notification
+    - skip_users: usernames that must not be notified (e.g. already notified
+                  by a previous attempt at the same job)
+    - on_delivered: if given, called as on_delivered(user, threads) after
+                    each notification is delivered
+    - report_path: local file of the 'offlinetest-batch' report
+    - before_delivery: if given, called as before_delivery(user) before
+                       each notification is delivered (before the report,
+                       for each of its users, in batch modes); it may raise
+                       to stop before posting
+
+    Output: list of the valid notifications (cf. generate_notification_list)
+    that were not delivered because the run deadline was reached; they are
+    marked 'deferred'.
+
+    Notifications are grouped by user: a user whose threads were archived
+    together receives a single edit, with one section per thread (cf.
+    notification_argstrs), rather than one edit per thread.
 
     No output to stdout, but this will cause posts on WP.
-    """
-    formatspec = 'pagelinked={pl}|threadname={tn}|archivelink={al}|'\
-                 + 'botname={bn}|editorname={en}'
+
+    Doctests:
+    >>> notify_all([{'user': 'Foo', 'thread': 'Bar', 'archivelink': 'A#Bar',
+    ...              'invalid': False},
+    ...             {'user': 'Foo', 'thread': 'Baz', 'archivelink': 'A#Baz',
+    ...              'invalid': False}], 'offlinetest',
+    ...            on_delivered=lambda user, threads: print(user, threads))
+    [[User talk:Foo]] -> {{subst:User:Tigraan-testbot/Teahouse archival notification|pagelinked=[[Wikipedia:Teahouse]]|threadname=Bar|archivelink=A#Bar|botname=Muninnbot|editorname=Foo}}
+    [[User talk:Foo]] -> {{subst:User:Tigraan-testbot/Teahouse archival notification|pagelinked=[[Wikipedia:Teahouse]]|threadname=Baz|archivelink=A#Baz|botname=Muninnbot|editorname=Foo}}
+    Foo [('Bar', 'A#Bar'), ('Baz', 'A#Baz')]
+    []
+    >>> def lease_lost(user):
+    ...     raise LeaseLost('Lease lost on job.')
+    >>> notify_all([{'user': 'Foo', 'thread': 'Bar', 'archivelink': 'A#Bar',
+    ...              'invalid': False}], 'offlinetest',
+    ...            before_delivery=lease_lost)  # nothing is printed
+    Traceback (most recent call last):
+      (some traceback)
+    LeaseLost: Lease lost on job.
+    """  # noqa: E501
     warnmsg = 'Thread "{thread}" by user {user} will not cause notification:'\
               + ' {reason}.'
+
+    batch = status in ('test-batch', 'offlinetest-batch')
+    report_entries = []  # (user, argstrs) for the batch test report
+
+    # Group valid notifications by user, keeping the original order
+    threads_by_user = collections.OrderedDict()
+    undelivered = []
     for item in notification_list:
         user = item['user']
         thread = item['thread']
@@ -880,58 +2843,702 @@ def notify_all(notification_list, status,
             continue
         archivelink = item['archivelink']
 
-        argstr = formatspec.format(pl=archive_from, tn=thread, al=archivelink,
-                                   bn=botname, en=user)
+        threads_by_user.setdefault(user, []).append((thread, archivelink))
+
+    for user, threads in threads_by_user.items():
+        if user in skip_users:
+            logging.info('User {user} was already notified.'.format(user=user))
+            continue
 
-        if status == 'offlinetest':
-            print('[[User talk:' + user + ']] -> {{subst:User:Tigraan-testbot/'
-                  + 'Teahouse archival notification|' + argstr + '}}')
+        if status != 'offlinetest' and not batch:
+            try:
+                check_deadline()
+            except DeadlineExceeded:
+                for thread, archivelink in threads:
+                    undelivered.append({'user': user, 'thread': thread,
+                                        'archivelink': archivelink,
+                                        'invalid': True, 'deferred': True,
+                                        'reason': 'run deadline reached, '
+                                                  'deferred to next run'})
+                continue
+
+        argstrs = notification_argstrs(user, threads, archive_from, botname)
+
+        if before_delivery is not None and not batch:
+            before_delivery(user)
+        if batch:
+            report_entries.append((user, argstrs))
+            continue  # delivered with the report, below
+        elif status == 'offlinetest':
+            for argstr in argstrs:
+                print('[[User talk:' + user + ']] -> {{subst:User:'
+                      + 'Tigraan-testbot/Teahouse archival notification|'
+                      + argstr + '}}')
         elif status == 'test-1':
-            notify(user, argstr, testlvl=1)
+            notify(user, argstrs, testlvl=1)
         elif status == 'test-2':
-            notify(user, argstr, testlvl=2)
+            notify(user, argstrs, testlvl=2)
         elif status == 'test-3':
-            notify(user, argstr, testlvl=3)
+            notify(user, argstrs, testlvl=3)
         elif status == 'prod':
-            notify(user, argstr, testlvl=0)
+            notify(user, argstrs, testlvl=0)
         else:
             raise ValueError('Option was not understood.', status)
 
+        if on_delivered is not None:
+            on_delivered(user, threads)
+
+    if report_entries:
+        try:
+            if status == 'test-batch':
+                check_deadline()
+        except DeadlineExceeded:
+            # The report is a single edit: defer all of it
+            for user, argstrs in report_entries:
+                for thread, archivelink in threads_by_user[user]:
+                    undelivered.append({'user': user, 'thread': thread,
+                                        'archivelink': archivelink,
+                                        'invalid': True, 'deferred': True,
+                                        'reason': 'run deadline reached, '
+                                                  'deferred to next run'})
+        else:
+            if before_delivery is not None:
+                for user, argstrs in report_entries:
+                    before_delivery(user)
+            deliver_test_report(report_entries, status,
+                                report_path=report_path)
+            if on_delivered is not None:
+                for user, argstrs in report_entries:
+                    on_delivered(user, threads_by_user[user])
+
+    if undelivered:
+        logging.warning('Run deadline reached: '
+                        + '{n} notifications deferred.'.format(
+                            n=len(undelivered)))
+    return undelivered
+
+
+# Work queue
+# Each job is one archival edit to process (cf. generate_notification_list).
+# Jobs are stored in a SQLite database, so that several worker processes
+# (possibly on several hosts sharing the file) can pull jobs safely: a
+# worker takes a time-limited lease on a job, and a job whose lease expired
+# (crashed worker) can be claimed again. Deliveries are recorded per user,
+# so that a reclaimed job never notifies a user twice.
+# Beware that SQLite locking is unreliable on some network filesystems.
+JOBS_DB = 'teahouse-jobs.sqlite'
+QUEUE_ENQUEUE_DAYS = 2  # days of archival edits queued by production runs
+
+
+def jobs_connect(path=JOBS_DB):
+    """Open the work queue database, creating tables if needed.
 
-def main():
-    """Run main procedure.
+    Doctests:
+    >>> conn = jobs_connect(':memory:')
+    >>> sorted(r[0] for r in conn.execute(
+    ...     "SELECT name FROM sqlite_master WHERE type='table'"))
+    ['deliveries', 'jobs']
+    """
+    # Autocommit mode: transactions are opened explicitly where needed
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                 'revid INTEGER PRIMARY KEY, '
+                 'payload TEXT NOT NULL, '
+                 "state TEXT NOT NULL DEFAULT 'pending', "
+                 'owner TEXT, '
+                 'lease_until REAL, '
+                 'attempts INTEGER NOT NULL DEFAULT 0)')
+    conn.execute('CREATE TABLE IF NOT EXISTS deliveries ('
+                 'revid INTEGER NOT NULL, '
+                 'user TEXT NOT NULL, '
+                 'PRIMARY KEY (revid, user))')
+    return conn
+
+
+def jobs_enqueue(conn, archival_edit_list):
+    """Add archival edits to the work queue.
+
+    Input: archival_edit_list is a list of dict (cf. parse_archival_edit).
+    Output: number of jobs actually added; edits already queued (whatever
+    their state) are ignored, so enqueuing the same window twice is safe.
+
+    Doctests:
+    >>> conn = jobs_connect(':memory:')
+    >>> jobs_enqueue(conn, [{'after': 2, 'before': 1, 'links': ['A']}])
+    1
+    >>> jobs_enqueue(conn, [{'after': 2, 'before': 1, 'links': ['A']},
+    ...                     {'after': 4, 'before': 3, 'links': ['A']}])
+    1
+    """
+    added = 0
+    for lae in archival_edit_list:
+        cursor = conn.execute('INSERT OR IGNORE INTO jobs (revid, payload) '
+                              'VALUES (?, ?)', (lae['after'], json.dumps(lae)))
+        added += cursor.rowcount
+    return added
+
+
+def jobs_claim(conn, worker, lease_seconds=1800, maxattempts=3):
+    """Claim the next available job of the work queue.
+
+    Input:
+    - conn: cf. jobs_connect
+    - worker: (string) unique name of the claiming worker
+    - lease_seconds: (int or float) duration of the lease
+    - maxattempts: (int) jobs claimed that many times are marked as failed
+      instead of being claimed again, whether they were given back after an
+      error (cf. run_worker) or their lease expired
+
+    Output: the job's archival edit (dict, cf. parse_archival_edit), or None
+    if no job is available. Pending jobs, and jobs whose lease expired, are
+    available; the oldest archival edit is claimed first.
+
+    Doctests:
+    >>> conn = jobs_connect(':memory:')
+    >>> jobs_enqueue(conn, [{'after': 2, 'before': 1, 'links': ['A']}])
+    1
+    >>> jobs_claim(conn, 'worker-1', lease_seconds=-1)['after']  # expired
+    2
+    >>> jobs_claim(conn, 'worker-2')['after']  # expired lease is reclaimed
+    2
+    >>> jobs_claim(conn, 'worker-3') is None  # leased by worker-2
+    True
+    >>> conn = jobs_connect(':memory:')
+    >>> jobs_enqueue(conn, [{'after': 2, 'before': 1, 'links': ['A']}])
+    1
+    >>> for attempt in range(3):  # the job fails every time
+    ...     job = jobs_claim(conn, 'worker-1')
+    ...     jobs_finish(conn, job['after'], 'worker-1', state='pending')
+    True
+    True
+    True
+    >>> jobs_claim(conn, 'worker-1') is None
+    True
+    >>> conn.execute('SELECT state, attempts FROM jobs').fetchone()
+    ('failed', 3)
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')  # lock the database against other claims
+    try:
+        conn.execute("UPDATE jobs SET state = 'failed' "
+                     "WHERE (state = 'pending' "
+                     "OR (state = 'leased' AND lease_until < ?)) "
+                     "AND attempts >= ?", (now, maxattempts))
+        row = conn.execute("SELECT revid, payload FROM jobs "
+                           "WHERE state = 'pending' "
+                           "OR (state = 'leased' AND lease_until < ?) "
+                           "ORDER BY revid LIMIT 1", (now,)).fetchone()
+        if row is None:
+            conn.execute('COMMIT')
+            return None
+        conn.execute("UPDATE jobs SET state = 'leased', owner = ?, "
+                     "lease_until = ?, attempts = attempts + 1 "
+                     "WHERE revid = ?", (worker, now + lease_seconds, row[0]))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+    return json.loads(row[1])
+
+
+class LeaseLost(Exception):
+    """The lease on a job was lost (cf. jobs_renew)."""
+
+
+def jobs_renew(conn, revid, worker, lease_seconds=1800):
+    """Extend the lease of a job, if the worker still holds it.
+
+    Output: True if the lease was extended, False if it was lost (expired and
+    claimed by another worker, or job already finished).
+    """
+    cursor = conn.execute("UPDATE jobs SET lease_until = ? "
+                          "WHERE revid = ? AND owner = ? AND state = 'leased'",
+                          (time.time() + lease_seconds, revid, worker))
+    return cursor.rowcount == 1
+
+
+def jobs_finish(conn, revid, worker, state='done'):
+    """Mark a job as finished ('done') or give it back ('pending').
+
+    Output: True if the worker still held the lease, False otherwise (in
+    which case the job is left untouched).
+
+    Doctests:
+    >>> conn = jobs_connect(':memory:')
+    >>> jobs_enqueue(conn, [{'after': 2, 'before': 1, 'links': ['A']}])
+    1
+    >>> job = jobs_claim(conn, 'worker-1')
+    >>> jobs_finish(conn, 2, 'worker-2')
+    False
+    >>> jobs_finish(conn, 2, 'worker-1')
+    True
+    >>> jobs_claim(conn, 'worker-1') is None
+    True
+    """
+    cursor = conn.execute("UPDATE jobs SET state = ?, lease_until = NULL "
+                          "WHERE revid = ? AND owner = ? AND state = 'leased'",
+                          (state, revid, worker))
+    return cursor.rowcount == 1
+
+
+def jobs_release(conn, revid, worker):
+    """Give a job back without counting the attempt.
+
+    This is for jobs interrupted by the run deadline rather than failed.
+    Output: cf. jobs_finish.
+    """
+    cursor = conn.execute("UPDATE jobs SET state = 'pending', "
+                          "lease_until = NULL, attempts = attempts - 1 "
+                          "WHERE revid = ? AND owner = ? AND state = 'leased'",
+                          (revid, worker))
+    return cursor.rowcount == 1
+
+
+def jobs_delivered_users(conn, revid):
+    """Get the set of users already notified for a job."""
+    rows = conn.execute('SELECT user FROM deliveries WHERE revid = ?',
+                        (revid,))
+    return {row[0] for row in rows}
+
+
+def jobs_record_delivery(conn, revid, user):
+    """Record that a user was notified for a job."""
+    conn.execute('INSERT OR IGNORE INTO deliveries (revid, user) '
+                 'VALUES (?, ?)', (revid, user))
+
+
+def default_worker_name():
+    """Get a worker name unique among running workers (host and PID)."""
+    return '{h}-{p}'.format(h=socket.gethostname(), p=os.getpid())
+
+
+def run_worker(worker, path=JOBS_DB, status='prod', lease_seconds=1800,
+               budget=None, fuzzy_threshold=None):
+    """Process jobs of the work queue until it is empty.
+
+    Input:
+    - worker: (string) unique name of this worker, e.g. host and PID
+    - path: path to the work queue database (cf. jobs_connect)
+    - status: cf. notify_all
+    - lease_seconds: lease duration, renewed after each read stage and
+      before each delivery
+    - budget: time budget of the worker in seconds (cf. set_run_deadline);
+      when it runs out, the current job is given back and the worker stops
+    - fuzzy_threshold: cf. generate_notification_list
+
+    Several workers can run at the same time on the same queue. Each job is
+    processed by a single worker at a time, and each user is notified at
+    most once per job even if a job is reclaimed after a crash: a worker
+    that lost its lease (e.g. too slow, so that the job was claimed again)
+    stops the job before posting anything more.
+
+    Output: number of jobs processed.
+    """
+    set_run_deadline(budget)
+    kwargs = {'archive_index_path': state_path(ARCHIVE_INDEX_FILE),
+              'registry_path': state_path(REGISTRY_FILE),
+              'fuzzy_threshold': fuzzy_threshold}
+    conn = jobs_connect(path)
+    processed = 0
+    while True:
+        lae = jobs_claim(conn, worker, lease_seconds=lease_seconds)
+        if lae is None:
+            break
+        revid = lae['after']
+        logging.info('Worker {w} processing archival '.format(w=worker)
+                     + 'edit {r}.'.format(r=revid))
+
+        def renew(*args):
+            if not jobs_renew(conn, revid, worker,
+                              lease_seconds=lease_seconds):
+                raise LeaseLost('Lease lost on job.', revid, worker)
+
+        def on_delivered(user, threads):
+            jobs_record_delivery(conn, revid, user)
+
+        reset_run_cache()
+        try:
+            notiflist = generate_notification_list(lae=lae, on_stage=renew,
+                                                   **kwargs)
+            undelivered = notify_all(
+                notiflist, status=status,
+                skip_users=jobs_delivered_users(conn, revid),
+                on_delivered=on_delivered, before_delivery=renew)
+            if undelivered or any(n.get('deferred') for n in notiflist):
+                raise DeadlineExceeded('Run deadline reached in job.', lae)
+        except DeadlineExceeded:
+            # Users already notified are skipped when the job is resumed
+            logging.warning('Run deadline reached: job '
+                            + '{r} given back to the queue.'.format(r=revid))
+            jobs_release(conn, revid, worker)
+            break
+        except LeaseLost:
+            # The job belongs to another worker now
+            logging.warning('Lease on job {r} was lost; '.format(r=revid)
+                            + 'job left to its new owner.')
+            continue
+        except Exception:
+            logging.exception('Job {r} failed.'.format(r=revid))
+            jobs_finish(conn, revid, worker, state='pending')
+            continue
+
+        if not jobs_finish(conn, revid, worker):
+            logging.warning('Lease on job {r} was lost '.format(r=revid)
+                            + 'before completion.')
+        processed += 1
+
+    conn.close()
+    return processed
+
+
+# Live smoke tests
+# Doctests that call the API of the English Wikipedia and compare the result
+# to its content at the time of writing. They are slow and will fail if that
+# content drifts, so they are not part of the offline suite and only run on
+# demand (cf. run_live_smoke_tests). Keys are the names of the tested
+# functions.
+LIVE_SMOKE_TESTS = {
+    'manual_API_call': """
+    >>> manual_API_call(pywikibot.Site(), action='parse', prop='sections',\
+            format='json', formatversion=2,\
+            oldid=837538913)['parse']['sections'][:2] ==\
+                [{'index': '1', 'anchor': 'Interesting_facts', 'toclevel': 1,\
+                  'line': 'Interesting facts','byteoffset': 3282,'level': '2',\
+                  'number': '1', 'fromtitle': 'Wikipedia:Teahouse'},\
+                 {'index': '2', 'anchor': 'oclc', 'toclevel': 1,\
+                  'line': 'oclc', 'byteoffset': 9831, 'number': '2',\
+                  'fromtitle': 'Wikipedia:Teahouse', 'level': '2'}]
+    True
+    """,
+    'get_user_info': """
+    >>> get_user_info(['Jimbo Wales','Sandbox for user warnings']
+    ...              ).keys() == {'Jimbo Wales','Sandbox for user warnings'}
+    True
+    >>> get_user_info(['Jimbo Wales'])['Jimbo Wales']['registration']
+    '2001-03-27T20:47:31Z'
+    >>> get_user_info(['Nonexisting username'])==\
+    {'Nonexisting username': {'missing': '', 'name': 'Nonexisting username'}}
+    True
+    """,
+    'get_block_info': """
+    >>> get_block_info(['Tigraan', '85.17.92.13', 'Nonexisting username']
+    ...                ) == {'Tigraan': False,
+    ...                      '85.17.92.13': True,
+    ...                      'Nonexisting username': False}
+    True
+    """,
+    'get_sections_from_revid': """
+    >>> get_sections_from_revid(783718598)[:2]==\
+    [{'anchor': 'Request:_World_Cafe',
+    ...  'byteoffset': 3329,
+    ...  'fromtitle': 'Wikipedia:Teahouse',
+    ...  'index': '1',
+    ...  'level': '2',
+    ...  'line': 'Request: World Cafe',
+    ...  'number': '1',
+    ...  'toclevel': 1},
+    ... {'anchor': 'How_to_publish_my_page',
+    ...  'byteoffset': 8292,
+    ...  'fromtitle': 'Wikipedia:Teahouse',
+    ...  'index': '2',
+    ...  'level': '2',
+    ...  'line': 'How to publish my page',
+    ...  'number': '2',
+    ...  'toclevel': 1}
+    ... ]
+    True
+    """,
+    'get_revisions_from_api': """
+    >>> get_revisions_from_api('Tiger','2018-03-01T00:00:00Z',
+    ...                        '2018-03-05T00:00:00Z') ==\
+    [{'timestamp': '2018-03-04T15:30:31Z',
+    ...  'parentid': 828307448,
+    ...  'comment': '/* Size */Journal cites: format page range,',
+    ...  'user': 'Rjwilmsi',
+    ...  'revid': 828751877},
+    ... {'timestamp': '2018-03-01T20:11:02Z',
+    ...  'parentid': 828233956,
+    ...  'comment': '/* Reproduction */ hatnote',
+    ...  'user': 'BDD',
+    ...  'revid': 828307448},
+    ... {'timestamp': '2018-03-01T10:08:52Z',
+    ...  'parentid': 828032712,
+    ...  'comment': '/* Taxonomy */ edited ref',
+    ...  'user': 'BhagyaMani',
+    ...  'revid': 828233956}]
+    True
+    """,
+    'isnotifiable': """
+    >>> isnotifiable(['Tigraan', '85.17.92.13', 'Nonexisting username']
+    ...              ) == {'Tigraan': True,
+    ...                    '85.17.92.13': False,
+    ...                    'Nonexisting username': False}
+    True
+    """,
+    'search_archives_for_section': """
+    >>> search_archives_for_section(['Wikipedia:Teahouse/Questions/Archive_98',
+    ...                              'Wikipedia:Teahouse/Questions/Archive_99'
+    ...                              ],['Picture problem', 'Blog as reference?'])  # noqa: E501
+    ['Wikipedia:Teahouse/Questions/Archive_98#Picture_problem', 'Wikipedia:Teahouse/Questions/Archive_99#Blog_as_reference?']
+    """,
+    'sections_removed_by_diff': """
+    (Cf. https://en.wikipedia.org/w/index.php?oldid=783715718&diff=783718598)
+    >>> sections_removed_by_diff(783715718,783718598)[:2]
+    ['Red links', 'how to undo a merge made 6 yrs ago']
+    """,
+}
 
-    Run once the full procedure:
-    - find last archival edit and extract archived threads
-    - lookup in the page history who created those threads
-    - check for each user whether they can be sent a notification
-    - send notifications for whoever can receive them
 
-    With PWB/OAuth we should be logged in everytime.
+def run_offline_selftest():
+    """Run the offline doctests of this module.
+
+    Those only use fixtures (no API call) and are fast.
+    Output: number of failed examples.
+    """
+    (failure_count, test_count) = doctest.testmod()
+    return failure_count
+
+
+def run_live_smoke_tests():
+    """Run the live smoke tests (cf. LIVE_SMOKE_TESTS).
+
+    Those make real API calls, so PWB must be configured.
+    Output: number of failed examples.
+    """
+    parser = doctest.DocTestParser()
+    runner = doctest.DocTestRunner()
+    for name, text in sorted(LIVE_SMOKE_TESTS.items()):
+        reset_run_cache()  # every test must reach the API
+        test = parser.get_doctest(text, globals(), name, __file__, 0)
+        runner.run(test)
+    return runner.summarize(verbose=False).failed
+
+
+def login(botname='Muninnbot'):
+    """Log in as the bot, fail if it does not work.
+
+    PWB persists the session cookies between runs, and its login first checks
+    that session with a single user information query: a full login only
+    happens if it is no longer valid. The user information is then cached by
+    PWB, so checking the logged-in user makes no further query. Likewise,
+    PWB fetches a new CSRF token by itself when an edit is rejected with
+    'badtoken'.
+
+    Output: the logged-in site.
     """
-    # try to log in, fail if it does not work
     s = pywikibot.Site()
+    check_deadline()
     s.login()
     assert s.logged_in()
 
     cur_user = whoami(site=s)
     logging.info('Currently logged as:' + cur_user)
-    assert cur_user == 'Muninnbot'
+    assert cur_user == botname
+    return s
+
+
+def main(budget=None, status='prod', fuzzy_threshold=None, jobs_path=None):
+    """Run main procedure.
+
+    Run once the full procedure:
+    - find last archival edit and extract archived threads
+    - lookup in the page history who created those threads
+    - check for each user whether they can be sent a notification
+    - send notifications for whoever can receive them
+
+    With PWB/OAuth we should be logged in everytime, except for the offline
+    test modes, which do not edit. Local state files are given by
+    state_path, i.e. kept apart for runs on a local dump.
+
+    status is the delivery mode, cf. notify_all. Production runs ('prod')
+    add the archival edits of the last QUEUE_ENQUEUE_DAYS days to the work
+    queue at jobs_path (default: JOBS_DB, cf. state_path), and process it as
+    a worker (cf. run_worker): runs started on several hosts then never
+    process the same archival edit at the same time, nor notify a user
+    twice, and what a run could not complete is resumed by the next one.
+    Runs in a test mode process the last archival edit directly, as below.
+
+    fuzzy_threshold enables similarity matching of thread titles, cf.
+    generate_notification_list.
+
+    budget is the time budget of the run in seconds (None for no limit), cf.
+    set_run_deadline. When it runs out, the notifications already proven
+    valid are still delivered, and the rest is saved in DEFERRED_TEST_FILE
+    to be completed at the next run.
+
+    The notifications to deliver are saved in DEFERRED_TEST_FILE before the
+    first delivery, and each one is removed from it as soon as it is
+    delivered, so that a crashed or killed run neither loses nor repeats
+    notifications (except the one being posted at that time).
+    """
+    reset_run_cache()
+    set_run_deadline(budget)
+    if status not in OFFLINE_STATUSES:
+        login()
+
+    if status == 'prod':
+        path = jobs_path or state_path(JOBS_DB)
+        conn = jobs_connect(path)
+        try:
+            added = jobs_enqueue(conn, archival_edits(
+                maxdays=QUEUE_ENQUEUE_DAYS))
+            logging.info('{n} new jobs added to the queue.'.format(n=added))
+        except Exception:
+            # Jobs queued by previous runs can still be processed
+            logging.warning('Archival edits could not be queued.',
+                            exc_info=True)
+        finally:
+            conn.close()
+        run_worker(default_worker_name(), path=path, status=status,
+                   budget=time_left(), fuzzy_threshold=fuzzy_threshold)
+        return
+
+    kwargs = {'archive_index_path': state_path(ARCHIVE_INDEX_FILE),
+              'registry_path': state_path(REGISTRY_FILE),
+              'fuzzy_threshold': fuzzy_threshold}
+    deferred_path = state_path(DEFERRED_TEST_FILE)
+    deferred = deferred_load(deferred_path)
+
+    # Work deferred by the previous run comes first; what still fails stays
+    # deferred, without stopping the run
+    notiflist, new_deferred = resume_deferred(deferred, **kwargs)
+
+    # If this run's archival edit is not processed, it is deferred; if it was
+    # not even found, the next run looks for it (cf. resume_deferred)
+    lookup = {'since': UTC_timestamp_x_days_ago(days_offset=1)}
+    skipped = None
+    try:
+        check_deadline()
+        notiflist += generate_notification_list(**kwargs)
+    except NoArchivalEdit:
+        logging.info('No archival edit in the last day: no new '
+                     + 'notification.')
+    except DeadlineExceeded as e:
+        lae = e.args[1] if len(e.args) > 1 else None
+        skipped = {'lae': lae} if lae else lookup
+    except Exception:
+        # Still deliver what was resolved; the edit is retried next run
+        logging.warning('Processing of the last archival edit failed; '
+                        + 'deferred to next run.', exc_info=True)
+        skipped = lookup
+    # An older lookup already covers this run
+    if skipped is not None and not (
+            'since' in skipped
+            and any('since' in item for item in new_deferred)):
+        new_deferred.append(skipped)
+
+    # The same thread may come both from deferred work and from this run
+    unique = collections.OrderedDict()
+    for notif in notiflist:
+        unique.setdefault((notif['user'], notif['thread']), notif)
+    notiflist = list(unique.values())
+
+    # Everything left to deliver is saved as deferred, and kept up to date
+    # after each delivery
+    to_deliver = [n for n in notiflist
+                  if not n['invalid'] or n.get('deferred')]
+
+    def save_deferred():
+        save_json_atomically(
+            new_deferred + [dict(n, invalid=True, deferred=True,
+                                 reason='not delivered yet, deferred to '
+                                        'next run')
+                            if not n.get('deferred') else n
+                            for n in to_deliver],
+            deferred_path)
+
+    def on_delivered(user, threads):
+        names = {thread for thread, archivelink in threads}
+        to_deliver[:] = [n for n in to_deliver
+                         if n['user'] != user or n['thread'] not in names]
+        save_deferred()
 
     # place the notifications
-    notiflist = generate_notification_list()
-    notify_all(notiflist, status='prod')
+    save_deferred()
+    notify_all(notiflist, status=status, on_delivered=on_delivered)
+    save_deferred()
 
-if __name__ == "__main__":
-    # Unit test run. See
-    # https://docs.python.org/3/library/doctest.html#simple-usage-checking-examples-in-docstrings
-    import doctest
-    logging.basicConfig(level=logging.ERROR)  # ignore logging warnings
-    (failure_count, test_count) = doctest.testmod()
 
-    if failure_count > 0:
-        logging.error("I failed at least one unit test, and will stop here.")
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Notify Teahouse users when their threads are archived.')
+    parser.add_argument('--selftest', action='store_true',
+                        help='run the offline doctests and exit')
+    parser.add_argument('--live-selftest', action='store_true',
+                        help='run the offline doctests and the live API smoke '
+                             'tests, and exit')
+    parser.add_argument('--enqueue', type=float, metavar='DAYS',
+                        help='add the archival edits of the last DAYS days to '
+                             'the work queue, and exit')
+    parser.add_argument('--worker', metavar='NAME',
+                        help='process the work queue as worker NAME (must be '
+                             'unique among running workers) until it is empty')
+    parser.add_argument('--jobs-db', metavar='PATH',
+                        help='work queue database (default: ' + JOBS_DB
+                             + ', or in the state directory of --dump)')
+    parser.add_argument('--budget', type=float, metavar='SECONDS',
+                        help='time budget of the run; what cannot be done in '
+                             'time is deferred to the next run')
+    parser.add_argument('--status',
+                        choices=['prod', 'test-2', 'test-3', 'test-batch',
+                                 'offlinetest', 'offlinetest-batch'],
+                        help='delivery mode (default: prod, or '
+                             'offlinetest-batch with --dump); test-batch '
+                             'writes a single report to the log page, '
+                             'offlinetest-batch to ' + REPORT_FILE)
+    parser.add_argument('--fuzzy-threshold', type=float, metavar='T',
+                        help='also match thread titles edited after creation '
+                             'if their similarity is at least T (between 0 '
+                             'and 1, e.g. 0.8)')
+    parser.add_argument('--rebuild-archive-index', action='store_true',
+                        help='index the archive pages not indexed yet, and '
+                             'exit')
+    parser.add_argument('--dump', metavar='PATH',
+                        help='read page histories and contents from the '
+                             'local MediaWiki XML dump at PATH instead of '
+                             'the API (indexed on first use); local state '
+                             'files are kept in PATH.state')
+    args = parser.parse_args()
+    if args.status is None:
+        args.status = 'offlinetest-batch' if args.dump else 'prod'
+    elif args.dump and args.status in ('prod', 'test-3'):
+        # Dumps are for old archival edits, whose users must not be notified
+        parser.error('--dump cannot be used with --status ' + args.status)
+
+    if args.selftest or args.live_selftest:
+        # Unit test run. See
+        # https://docs.python.org/3/library/doctest.html#simple-usage-checking-examples-in-docstrings
+        logging.basicConfig(level=logging.ERROR)  # ignore logging warnings
+        failure_count = run_offline_selftest()
+        if args.live_selftest:
+            failure_count += run_live_smoke_tests()
+        if failure_count > 0:
+            logging.error("I failed at least one unit test.")
+        sys.exit(1 if failure_count else 0)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.dump:
+        use_dump(args.dump)
+    jobs_db = args.jobs_db or state_path(JOBS_DB)
+    if args.rebuild_archive_index:
+        archive_index_path = state_path(ARCHIVE_INDEX_FILE)
+        with file_lock(archive_index_path):
+            archive_index = archive_index_load(archive_index_path)
+            try:
+                archive_index_rebuild(archive_index)
+            finally:  # keep what was indexed, even if interrupted
+                save_json_atomically(archive_index, archive_index_path)
+    elif args.enqueue is not None:
+        added = jobs_enqueue(jobs_connect(jobs_db),
+                             archival_edits(maxdays=args.enqueue,
+                                            maxcontinuenumber=50))
+        logging.info('{n} new jobs added to the queue.'.format(n=added))
+    elif args.worker:
+        if args.status not in OFFLINE_STATUSES:
+            login()
+        run_worker(args.worker, path=jobs_db, status=args.status,
+                   budget=args.budget, fuzzy_threshold=args.fuzzy_threshold)
     else:
-        logging.basicConfig(level=logging.INFO)
-        logging.info("Unit tests passed. Executing the full procedure...")
-        main()
+        main(budget=args.budget, status=args.status,
+             fuzzy_threshold=args.fuzzy_threshold, jobs_path=args.jobs_db)